@@ -61,649 +61,450 @@
 
 
 # importing libraries
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import time
+import traceback
+
 import numpy as np
 import pandas as pd
 
 
-# **Importing Data**
+# **Codebook**
+#
+# Column selection, renames, text cleanup, value maps, recode assignments,
+# test conditions, composite scales, scale segments, the aggregate cube and
+# output columns all live in SDO_Campaigns_Codebook.json. compile_codebook
+# turns it into a plan that is run as one column projection, one rename, one
+# text pass, one batched recode, one condition pass, one combine pass, one
+# scoring pass and one segmentation pass.
 
 # In[2]:
 
 
-df = pd.read_csv('SDO_Campaigns_HumanReadable.csv')
-
-# removing unnecessary columns
-df.drop(
-    columns=[
-        'StartDate',
-        'EndDate',
-        'Status',
-        'Progress',
-        'Duration__in_seconds_',
-        'Finished',
-        'DistributionChannel',
-        'RecordedDate',
-        'Q3_Consent'
-    ], 
-    axis=0,
-    inplace=True
-)
-
-
-# renaming SDO variables
-df.rename(
-    index=str, 
-    columns={
-        # Pro Trait dominance variables
-        'SDO_Q5_1':'sdo1_Pro_Trait_Dom1',
-        'SDO_Q5_13':'sdo13_Pro_Trait_Dom2',
-        
-        # Con Trait Dominance variables
-        'SDO_Q5_6':'sdo6_Con_Trait_Dom2',                
-        'SDO_Q5_2':'sdo2_Con_Trait_Dom1',
-        
-        # Pro Trait AntiEgalitarianism
-        'SDO_Q5_7':'sdo7_Pro_Trait_AntiEgal1',        
-        'SDO_Q5_3':'sdo3_Pro_Trait_AntiEgal2',
-
-        # Con Trait AntiEgalitarianism
-        'SDO_Q5_14':'sdo14_Con_Trait_AntiEgal1',        
-        'SDO_Q5_4':'sdo4_Con_Trait_AntiEgal2'
-    }, inplace=True)
-
-# renaming Political Variables
-df.rename(
-    index=str, 
-    columns={
-        
-        # Political Ideology
-        'Political_Views_Q6_2':'ideol2_social',
-        'Political_Views_Q6_3':'ideol3_self',
-        'Political_Views_Q6_4':'ideol4_econ',
-        
-        # Public Trust
-        'Public_Trust_Q7_13':'trust13_officials',        
-        'Public_Trust_Q7_6':'trust6_nocare',
-        'Public_Trust_Q7_2':'trust2_nosay',
-        
-        # Interest, Voter
-        'Q8_13':'pol_interest',
-        'Q9_13':'pol_vote',        
-        
-    }, inplace=True)
-
-
-# renaming demo variables
-df.rename(
-    index=str, 
-    columns={
-        
-        # demographic variables
-        'Q11':'Age',
-        'Q12':'Ethnicity',
-        'Q13':'Sex'
-    }, inplace=True)
-
-
-# renaming Q20/Q21 - (H-SDO) & (Civil-Positive) -
-df.rename(
-    index=str, 
-    columns={
-        # Q20 -  
-        'Q20_14':'Q20_mess14_imprtnt',
-        'Q20_15':'Q20_mess15_inform',
-        'Q20_13':'Q20_mess13_fair',
-        
-        # Q21 - 
-        'Q21_1':'Q21_cand1_strong',
-        'Q21_13':'Q21_cand13_relate',    
-        'Q21_6':'Q21_cand6_weak',    
-        'Q21_2':'Q21_cand2_dishonest',    
-        'Q21_7':'Q21_cand7_friends',    
-        'Q21_3':'Q21_cand3_aggressive',    
-        'Q21_4':'Q21_cand4_moral',    
-        'Q21_14':'Q21_cand14_competent',  
-        'Q21_15':'Q21_cand15_votefor',  
-        'Q21_16':'Q21_cand16_volunteer',          
-        'Q21_17':'Q21_cand17_persuade',                  
-    }, inplace=True)
-
-
-# renaming Q30/Q31 - (L-SDO) & (Civil-Positive)
-df.rename(
-    index=str, 
-    columns={
-        # Q30 -  
-        'Q30_14':'Q30_mess14_imprtnt',
-        'Q30_15':'Q30_mess15_inform',
-        'Q30_13':'Q30_mess13_fair',
-        
-        # Q31 - 
-        'Q31_1':'Q31_cand1_strong',
-        'Q31_13':'Q31_cand13_relate',    
-        'Q31_6':'Q31_cand6_weak',    
-        'Q31_2':'Q31_cand2_dishonest',    
-        'Q31_7':'Q31_cand7_friends',    
-        'Q31_3':'Q31_cand3_aggressive',    
-        'Q31_4':'Q31_cand4_moral',    
-        'Q31_14':'Q31_cand14_competent',  
-        'Q31_15':'Q31_cand15_votefor',  
-        'Q31_16':'Q31_cand16_volunteer',          
-        'Q31_17':'Q31_cand17_persuade',                  
-    }, inplace=True)
-
-# renaming Q40/Q41 - (H-SDO) & (Civil-Negative) - 
-df.rename(
-    index=str, 
-    columns={
-        # Q40 -  
-        'Q40_14':'Q40_mess14_imprtnt',
-        'Q40_15':'Q40_mess15_inform',
-        'Q40_13':'Q40_mess13_fair',
-        
-        # Q41 - 
-        'Q41_1':'Q41_cand1_strong',
-        'Q41_13':'Q41_cand13_relate',    
-        'Q41_6':'Q41_cand6_weak',    
-        'Q41_2':'Q41_cand2_dishonest',    
-        'Q41_7':'Q41_cand7_friends',    
-        'Q41_3':'Q41_cand3_aggressive',    
-        'Q41_4':'Q41_cand4_moral',    
-        'Q41_14':'Q41_cand14_competent',  
-        'Q41_15':'Q41_cand15_votefor',  
-        'Q41_16':'Q41_cand16_volunteer',          
-        'Q41_17':'Q41_cand17_persuade',                  
-    }, inplace=True)
-
-# renaming Q50/Q51 - (L-SDO) & (Civil-Negative)
-df.rename(
-    index=str, 
-    columns={
-        # Q50 -  
-        'Q50_14':'Q50_mess14_imprtnt',
-        'Q50_15':'Q50_mess15_inform',
-        'Q50_13':'Q50_mess13_fair',
-        
-        # Q51 - 
-        'Q51_1':'Q51_cand1_strong',
-        'Q51_13':'Q51_cand13_relate',    
-        'Q51_6':'Q51_cand6_weak',    
-        'Q51_2':'Q51_cand2_dishonest',    
-        'Q51_7':'Q51_cand7_friends',    
-        'Q51_3':'Q51_cand3_aggressive',    
-        'Q51_4':'Q51_cand4_moral',    
-        'Q51_14':'Q51_cand14_competent',  
-        'Q51_15':'Q51_cand15_votefor',  
-        'Q51_16':'Q51_cand16_volunteer',          
-        'Q51_17':'Q51_cand17_persuade',                  
-    }, inplace=True)
-
-
-# renaming Q60/Q61 - (H-SDO) & (UnCivil) - 
-df.rename(
-    index=str, 
-    columns={
-        # Q60 -  
-        'Q60_14':'Q60_mess14_imprtnt',
-        'Q60_15':'Q60_mess15_inform',
-        'Q60_13':'Q60_mess13_fair',
-        
-        # Q61 - 
-        'Q61_1':'Q61_cand1_strong',
-        'Q61_13':'Q61_cand13_relate',    
-        'Q61_6':'Q61_cand6_weak',    
-        'Q61_2':'Q61_cand2_dishonest',    
-        'Q61_7':'Q61_cand7_friends',    
-        'Q61_3':'Q61_cand3_aggressive',    
-        'Q61_4':'Q61_cand4_moral',    
-        'Q61_14':'Q61_cand14_competent',  
-        'Q61_15':'Q61_cand15_votefor',  
-        'Q61_16':'Q61_cand16_volunteer',          
-        'Q61_17':'Q61_cand17_persuade',                  
-    }, inplace=True)
-
-
-# renaming Q70/Q71 - (L-SDO) & (UnCivil) -
-df.rename(
-    index=str, 
-    columns={
-        # Q70 -  
-        'Q70_14':'Q70_mess14_imprtnt',
-        'Q70_15':'Q70_mess15_inform',
-        'Q70_13':'Q70_mess13_fair',
-        
-        # Q71 - 
-        'Q71_1':'Q71_cand1_strong',
-        'Q71_13':'Q71_cand13_relate',    
-        'Q71_6':'Q71_cand6_weak',    
-        'Q71_2':'Q71_cand2_dishonest',    
-        'Q71_7':'Q71_cand7_friends',    
-        'Q71_3':'Q71_cand3_aggressive',    
-        'Q71_4':'Q71_cand4_moral',    
-        'Q71_14':'Q71_cand14_competent',  
-        'Q71_15':'Q71_cand15_votefor',  
-        'Q71_16':'Q71_cand16_volunteer',          
-        'Q71_17':'Q71_cand17_persuade',                  
-    }, inplace=True)
-
-
-
-df['pol_interest'] = df.pol_interest.str.replace('\(|\)', '')
-df['pol_interest'] = df.pol_interest.str.replace('Highest Interest |Lowest Interest ', '')
-df['pol_vote'] = df.pol_interest.str.replace('\(|\)', '')
+EXPORT_FILE = 'SDO_Campaigns_HumanReadable.csv'
+CODEBOOK_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'SDO_Campaigns_Codebook.json')
+CACHE_DIR = '.sdo_cache'
+ALL_FILE = 'A1-SDO_Campaigns_All.csv'
+FILTER_FILE = 'A2-SDO_Campaigns_filter.csv'
+LONG_FILE = 'A3-SDO_Campaigns_Long.csv'
+CUBE_FILE = 'A4-SDO_Campaigns_Cube.csv'
+# one A2 file per EXP_Cond_HR label, e.g. A5-SDO_Campaigns_Conditions/HE-Uncivil.csv
+PARTITION_DIR = 'A5-SDO_Campaigns_Conditions'
+
+# columnar copies of A1/A2 are dataset directories named after the CSV, e.g.
+# A1-SDO_Campaigns_All.parquet/, holding one part file per write
+COLUMNAR_FORMATS = {'parquet': '.parquet', 'feather': '.feather'}
+
+# rows formatted per CSV write (and converted per Parquet row group or
+# Feather record batch) and the size of the CSV file buffer; together they
+# bound the memory the export adds on top of the working frame
+CSV_CHUNKSIZE = 20000
+CSV_BUFFER = 1 << 20
+ERRORS_FILE = 'SDO_Campaigns_BatchErrors.csv'
+STATE_FILE = 'SDO_Campaigns_Incremental.json'
+IDS_FILE = 'SDO_Campaigns_ProcessedIds.txt'
+UNMAPPED_FILE = 'SDO_Campaigns_Unmapped.csv'
+
+# every recoded item, EXP_Cond and the combined items are 1-7 codes (or
+# missing), stored as nullable one-byte integers
+ITEM_DTYPE = 'Int8'
+
+
+def load_codebook(path=CODEBOOK_FILE):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def compile_codebook(codebook):
+    # expands the per-block item templates and groups every column by the
+    # value map it is recoded with
+    values = codebook['values']
+    rename = dict(codebook['rename'])
+    recode = dict(codebook['recode'])
+    conditions = []
+    combine = {}
+    for cond in codebook['conditions']:
+        columns = []
+        for kind, prefix in [('message', cond['message']),
+                             ('candidate', cond['candidate'])]:
+            for item in codebook['items'][kind]:
+                column = '{}_{}'.format(prefix, item['name'])
+                rename['{}_{}'.format(prefix, item['question'])] = column
+                recode[column] = item['values']
+                combine.setdefault(item['name'], (item['values'], []))[1].append(column)
+                columns.append(column)
+        conditions.append((cond['code'], cond['label'], columns))
+
+    # text steps rewrite their columns before recoding, so those columns are
+    # parsed as categoricals without a fixed label set
+    text_columns = set()
+    for step in codebook['text']:
+        text_columns.update([step['column'], step['source']])
+    raw_names = {new: raw for raw, new in rename.items()}
+    text_sources = sorted(set(
+        raw_names.get(step['source'], step['source'])
+        for step in codebook['text']))
+    categories = {
+        raw: list(values[recode[new]])
+        for raw, new in rename.items()
+        if new in recode and new not in text_columns
+    }
+
+    # (block type, item name) of each item, in the order the items appear in
+    # every condition block
+    items = [(kind, item['name'])
+             for kind in ['message', 'candidate']
+             for item in codebook['items'][kind]]
+
+    # every (item, reverse offset) pair used by a scale becomes one column of
+    # the scoring matrix; weights[i, j] is 1 when that column is in scale j
+    scale_columns = []
+    for scale in codebook['scales']:
+        reverse = set(scale.get('reverse', []))
+        for column in scale['items']:
+            key = (column, sum(scale['range']) if column in reverse else 0)
+            if key not in scale_columns:
+                scale_columns.append(key)
+    weights = np.zeros((len(scale_columns), len(codebook['scales'])), dtype='float32')
+    for j, scale in enumerate(codebook['scales']):
+        reverse = set(scale.get('reverse', []))
+        for column in scale['items']:
+            key = (column, sum(scale['range']) if column in reverse else 0)
+            weights[scale_columns.index(key), j] = 1
+
+    groups = {}
+    for column, name in recode.items():
+        groups.setdefault(name, []).append(column)
+
+    return {
+        'usecols': list(codebook['keep']) + list(rename),
+        'rename': rename,
+        'categories': categories,
+        'text_sources': text_sources,
+        'text': [(step['column'], step['source'],
+                  [re.compile(pattern) for pattern in step['remove']])
+                 for step in codebook['text']],
+        'recode': [(values[name], columns) for name, columns in groups.items()],
+        'conditions': conditions,
+        'items': items,
+        'nontest': (codebook['nontest']['code'], codebook['nontest']['label']),
+        'combine': [
+            (name, columns,
+             sorted(set(v for v in values[map_name].values() if v is not None)))
+            for name, (map_name, columns) in combine.items()],
+        'scales': {
+            'names': [scale['name'] for scale in codebook['scales']],
+            'columns': scale_columns,
+            'weights': weights,
+            'min_valid': np.array(
+                [scale['min_valid'] for scale in codebook['scales']], dtype='float32'),
+        },
+        'segments': codebook['segments'],
+        'cube': codebook['cube'],
+        'outputs': codebook['outputs'],
+    }
 
 
-# In[3]:
+# **Importing Data**
 
+# In[3]:
 
-# Positive coding SDO (LowSDO)1-7(HighSDO)
-SDO_values = {
-    'NO RESPONSE': None,
-    'Strongly Disagree': 1,
-    'Disagree': 2,
-    'Slightly Disagree': 3,
-    'Neither Agree nor Disagree':4,
-    'Slightly Agree':5,
-    'Agree':6,    
-    'Strongly Agree':7
-}
-
-# reverse coded SDO (HighSDO)1-7(LowSDO)
-SDO_ReverseCode = {
-    'NO RESPONSE': None,
-    'Strongly Disagree': 7,
-    'Disagree': 6,
-    'Slightly Disagree': 5,
-    'Neither Agree nor Disagree':4,
-    'Slightly Agree':3,
-    'Agree':2,    
-    'Strongly Agree':1
-}
-
-# Political Ideology (Very Liberal)1-7(Very Conservative)
-ideology_values = {
-    'NO RESPONSE': None,
-    'Very Liberal': 1,
-    'Liberal': 2,
-    'Slightly Liberal': 3,
-    'Neither Liberal nor Conservative':4,
-    'Slightly Conservative':5,
-    'Conservative':6,    
-    'Very Conservative':7
-}
-
-
-# political trust (Strongly Disagree)1-7(Strongly Agree)
-trust_values = {
-    'NO RESPONSE': None,
-    'Strongly Disagree': 1,
-    'Disagree': 2,
-    'Slightly Disagree': 3,
-    'Neither Agree nor Disagree':4,
-    'Slightly Agree':5,
-    'Agree':6,    
-    'Strongly Agree':7
-}
-
-
-# Voter interest (LowInterest)1-4(High Interest)
-interest_values = {
-    'NO RESPONSE': None,
-    'Strongly Disagree': 1,
-    'Disagree': 2,
-    'Slightly Disagree': 3,
-    'Neither Agree nor Disagree':4,
-}
-
-
-# vote turnout (NOT turnout)1-4(WILL turnout)
-pol_voter_values = {
-    'NO RESPONSE': None,
-    '1': 1,
-    '-2': 2,
-    '-3': 3,
-    '4':4,
-}
-
-
-# vote turnout (NOT turnout)1-4(WILL turnout)
-pol_interest_values = {
-    'NO RESPONSE': None,
-    'Will definitely NOT vote 1': 1,
-    '-2': 2,
-    '-3': 3,
-    'Will definitely vote 4':4,
-}
-
-
-# Message Values (Strongly Disagree)1-4(Strongly Agree)
-mess_values = {
-    'NO RESPONSE': None,
-    'Strongly Disagree': 1,
-    'Disagree': 2,
-    'Agree': 3,
-    'Strongly Agree': 4   
-}
-
-# Candidate Values (Strongly Disagree)1-7(Strongly Agree)
-cand_values = {
-    'NO RESPONSE': None,
-    'Strongly Disagree': 1,
-    'Disagree': 2,
-    'Slightly Disagree': 3,
-    'Neither Agree nor Disagree': 4,   
-    'Slightly Agree': 5,
-    'Agree': 6,
-    'Strongly Agree': 7,    
-}
-
-
-# Candidate Values (Strongly Agree)1-7(Strongly Disagree)
-cand_reverse_values = {
-    'NO RESPONSE': None,
-    'Strongly Agree': 1,    
-    'Agree': 2,
-    'Slightly Agree': 3,
-    'Neither Agree nor Disagree': 4,   
-    'Slightly Disagree': 5,
-    'Disagree': 6,
-    'Strongly Disagree': 7,
-}
 
+def likert_dtypes(plan):
+    # Likert label and text columns are parsed as categoricals so every cell
+    # is held as a small integer code from the start
+    dtype = {column: 'category' for column in plan['categories']}
+    dtype.update((column, 'category') for column in plan['text_sources'])
+    return dtype
+
+
+def fix_categories(df, plan):
+    # puts the fixed label set first, in mapping order, so the codes mean the
+    # same thing in every chunk; labels outside the set are kept at the end
+    # instead of being turned into NaN
+    for column, categories in plan['categories'].items():
+        if column in df.columns:
+            extra = [c for c in df[column].cat.categories if c not in categories]
+            df[column] = df[column].cat.set_categories(categories + extra)
+    return df
+
+
+class ExportSlice(io.RawIOBase):
+    # read-only view of an open export that stops at byte offset end, so a
+    # run parses a fixed set of rows even while the export is growing
+
+    def __init__(self, fh, end):
+        self.fh = fh
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.end - self.fh.tell())
+        if size <= 0:
+            return 0
+        return self.fh.readinto(memoryview(buffer)[:size])
+
+
+@contextlib.contextmanager
+def export_slice(path, start, end):
+    # buffered binary handle on bytes start..end of the export
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        yield io.BufferedReader(ExportSlice(fh, end), CSV_BUFFER)
+
+
+def field_count(line):
+    return len(next(csv.reader([line.decode('utf-8', 'replace')]), []))
+
+
+def complete_size(path, blocksize=1 << 16):
+    # the end of the last complete row of the export: its current size,
+    # cut back to just after the last newline when the bytes after it are a
+    # partly written row (fewer fields than the header). A last row that is
+    # complete but has no trailing newline is kept
+    size = end = os.path.getsize(path)
+    with open(path, 'rb') as fh:
+        header = fh.readline()
+        cut = 0
+        while end > 0:
+            start = max(end - blocksize, 0)
+            fh.seek(start)
+            newline = fh.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                cut = start + newline + 1
+                break
+            end = start
+        fh.seek(cut)
+        tail = fh.read(size - cut)
+    if tail and field_count(tail) >= field_count(header):
+        return size
+    return cut
+
+
+def read_export(path, plan, chunksize=None, engine='c', end=None):
+    # returns a DataFrame, or an iterator of DataFrames when chunksize is set;
+    # only the columns the plan uses are parsed. engine='pyarrow' parses with
+    # Arrow's multi-threaded CSV reader. With end set only the first end
+    # bytes of the export are parsed
+    options = dict(usecols=plan['usecols'], dtype=likert_dtypes(plan))
+    if chunksize is not None:
+        return (fix_categories(chunk, plan)
+                for chunk in pd.read_csv(path, chunksize=chunksize, **options))
+
+    start = time.perf_counter()
+    if end is None:
+        df = pd.read_csv(path, engine=engine, **options)
+    else:
+        with export_slice(path, 0, end) as fh:
+            df = pd.read_csv(fh, engine=engine, **options)
+    df = fix_categories(df, plan)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    megabytes = (os.path.getsize(path) if end is None else end) / 1e6
+    print('Read {:,} rows ({:.1f} MB) with the {} engine in {:.2f}s: '
+          '{:.1f} MB/s, {:,.0f} rows/s\n'.format(
+              len(df), megabytes, engine, elapsed,
+              megabytes / elapsed, len(df) / elapsed))
+    return df
+
+
+def export_hash(path, plan, blocksize=1 << 20):
+    # content hash of the export plus the ingest settings, so the cache is
+    # rebuilt when the file, the projected columns or the label sets change
+    digest = hashlib.sha256(
+        repr((plan['usecols'], plan['categories'], plan['text_sources']))
+        .encode('utf-8'))
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ingest(path, plan, cache_dir=None, engine='c', end=None):
+    # the projected read_csv; with a cache_dir the result is kept as an
+    # uncompressed Feather file keyed by export_hash and memory-mapped on
+    # later runs instead of parsing the CSV again
+    if cache_dir is None:
+        return read_export(path, plan, engine=engine, end=end)
+
+    from pyarrow import feather
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    cache_file = os.path.join(
+        cache_dir, '{}-{}.feather'.format(stem, export_hash(path, plan)[:16]))
+    if os.path.exists(cache_file):
+        print('Reading cached export {}\n'.format(cache_file))
+        return feather.read_table(cache_file, memory_map=True).to_pandas()
+
+    df = read_export(path, plan, engine=engine)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary name first so an interrupted run never leaves a
+    # truncated cache file behind
+    tmp_file = cache_file + '.tmp'
+    feather.write_feather(df, tmp_file, compression='uncompressed')
+    os.replace(tmp_file, cache_file)
+    print('Cached export as {}\n'.format(cache_file))
+    return df
+
+
+def rename_columns(df, plan):
+    df.rename(columns=plan['rename'], inplace=True)
+    return df
+
+
+def normalize_labels(series, patterns):
+    # removes every pattern from the distinct labels only and maps the
+    # cleaned labels back through the integer codes; labels that become
+    # equal after cleaning share one category
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, labels = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        codes, labels = pd.factorize(series)
+    cleaned = []
+    for label in labels:
+        label = str(label)
+        for pattern in patterns:
+            label = pattern.sub('', label)
+        cleaned.append(label)
+    cleaned_codes, cleaned_labels = pd.factorize(pd.Index(cleaned, dtype=object))
+    return pd.Categorical.from_codes(
+        np.append(cleaned_codes, -1)[codes], categories=cleaned_labels)
+
+
+def clean_text(df, plan):
+    # e.g. pol_interest: drop the parentheses and the scale anchor prefixes
+    for column, source, patterns in plan['text']:
+        df[column] = normalize_labels(df[source], patterns)
+    return df
+
+
+# **Recoding**
 
 # In[4]:
 
 
-# pro-SDO
-df.sdo1_Pro_Trait_Dom1.replace(SDO_values, inplace=True)
-df.sdo13_Pro_Trait_Dom2.replace(SDO_values, inplace=True)
-df.sdo7_Pro_Trait_AntiEgal1.replace(SDO_values, inplace=True)
-df.sdo3_Pro_Trait_AntiEgal2.replace(SDO_values, inplace=True)
-
-# con-SDO
-df.sdo2_Con_Trait_Dom1.replace(SDO_ReverseCode, inplace=True)
-df.sdo6_Con_Trait_Dom2.replace(SDO_ReverseCode, inplace=True)
-df.sdo14_Con_Trait_AntiEgal1.replace(SDO_ReverseCode, inplace=True)
-df.sdo4_Con_Trait_AntiEgal2.replace(SDO_ReverseCode, inplace=True)
-
-# political ideology
-df.ideol3_self.replace(ideology_values, inplace=True)
-df.ideol4_econ.replace(ideology_values, inplace=True)
-df.ideol2_social.replace(ideology_values, inplace=True)
-
-# political interest
-df.pol_interest.replace(pol_interest_values, inplace=True)
-df.pol_vote.replace(pol_voter_values, inplace=True)
-
-# political trust
-df.trust13_officials.replace(trust_values, inplace=True)
-df.trust2_nosay.replace(trust_values, inplace=True)
-df.trust6_nocare.replace(trust_values, inplace=True)
-
-
-# Q20
-df.Q20_mess13_fair.replace(mess_values, inplace=True)
-df.Q20_mess14_imprtnt.replace(mess_values, inplace=True)
-df.Q20_mess15_inform.replace(mess_values, inplace=True)
-
-# Q21
-df.Q21_cand1_strong.replace(cand_values, inplace=True)
-df.Q21_cand2_dishonest.replace(cand_reverse_values, inplace=True)
-df.Q21_cand3_aggressive.replace(cand_reverse_values, inplace=True)
-df.Q21_cand4_moral.replace(cand_values, inplace=True)
-df.Q21_cand6_weak.replace(cand_reverse_values, inplace=True)
-df.Q21_cand7_friends.replace(cand_values, inplace=True)
-df.Q21_cand13_relate.replace(cand_values, inplace=True)
-df.Q21_cand14_competent.replace(cand_values, inplace=True)
-df.Q21_cand15_votefor.replace(cand_values, inplace=True)
-df.Q21_cand16_volunteer.replace(cand_values, inplace=True)
-df.Q21_cand17_persuade.replace(cand_values, inplace=True)
-
-
-# Q30
-df.Q30_mess13_fair.replace(mess_values, inplace=True)
-df.Q30_mess14_imprtnt.replace(mess_values, inplace=True)
-df.Q30_mess15_inform.replace(mess_values, inplace=True)
-
-# Q31
-df.Q31_cand1_strong.replace(cand_values, inplace=True)
-df.Q31_cand2_dishonest.replace(cand_reverse_values, inplace=True)
-df.Q31_cand3_aggressive.replace(cand_reverse_values, inplace=True)
-df.Q31_cand4_moral.replace(cand_values, inplace=True)
-df.Q31_cand6_weak.replace(cand_reverse_values, inplace=True)
-df.Q31_cand7_friends.replace(cand_values, inplace=True)
-df.Q31_cand13_relate.replace(cand_values, inplace=True)
-df.Q31_cand14_competent.replace(cand_values, inplace=True)
-df.Q31_cand15_votefor.replace(cand_values, inplace=True)
-df.Q31_cand16_volunteer.replace(cand_values, inplace=True)
-df.Q31_cand17_persuade.replace(cand_values, inplace=True)
-
-
-# Q40
-df.Q40_mess13_fair.replace(mess_values, inplace=True)
-df.Q40_mess14_imprtnt.replace(mess_values, inplace=True)
-df.Q40_mess15_inform.replace(mess_values, inplace=True)
-
-# Q41
-df.Q41_cand1_strong.replace(cand_values, inplace=True)
-df.Q41_cand2_dishonest.replace(cand_reverse_values, inplace=True)
-df.Q41_cand3_aggressive.replace(cand_reverse_values, inplace=True)
-df.Q41_cand4_moral.replace(cand_values, inplace=True)
-df.Q41_cand6_weak.replace(cand_reverse_values, inplace=True)
-df.Q41_cand7_friends.replace(cand_values, inplace=True)
-df.Q41_cand13_relate.replace(cand_values, inplace=True)
-df.Q41_cand14_competent.replace(cand_values, inplace=True)
-df.Q41_cand15_votefor.replace(cand_values, inplace=True)
-df.Q41_cand16_volunteer.replace(cand_values, inplace=True)
-df.Q41_cand17_persuade.replace(cand_values, inplace=True)
-
-# Q50
-df.Q50_mess13_fair.replace(mess_values, inplace=True)
-df.Q50_mess14_imprtnt.replace(mess_values, inplace=True)
-df.Q50_mess15_inform.replace(mess_values, inplace=True)
-
-# Q51
-df.Q51_cand1_strong.replace(cand_values, inplace=True)
-df.Q51_cand2_dishonest.replace(cand_reverse_values, inplace=True)
-df.Q51_cand3_aggressive.replace(cand_reverse_values, inplace=True)
-df.Q51_cand4_moral.replace(cand_values, inplace=True)
-df.Q51_cand6_weak.replace(cand_reverse_values, inplace=True)
-df.Q51_cand7_friends.replace(cand_values, inplace=True)
-df.Q51_cand13_relate.replace(cand_values, inplace=True)
-df.Q51_cand14_competent.replace(cand_values, inplace=True)
-df.Q51_cand15_votefor.replace(cand_values, inplace=True)
-df.Q51_cand16_volunteer.replace(cand_values, inplace=True)
-df.Q51_cand17_persuade.replace(cand_values, inplace=True)
-
-
-# Q60
-df.Q60_mess13_fair.replace(mess_values, inplace=True)
-df.Q60_mess14_imprtnt.replace(mess_values, inplace=True)
-df.Q60_mess15_inform.replace(mess_values, inplace=True)
-
-# Q61
-df.Q61_cand1_strong.replace(cand_values, inplace=True)
-df.Q61_cand2_dishonest.replace(cand_reverse_values, inplace=True)
-df.Q61_cand3_aggressive.replace(cand_reverse_values, inplace=True)
-df.Q61_cand4_moral.replace(cand_values, inplace=True)
-df.Q61_cand6_weak.replace(cand_reverse_values, inplace=True)
-df.Q61_cand7_friends.replace(cand_values, inplace=True)
-df.Q61_cand13_relate.replace(cand_values, inplace=True)
-df.Q61_cand14_competent.replace(cand_values, inplace=True)
-df.Q61_cand15_votefor.replace(cand_values, inplace=True)
-df.Q61_cand16_volunteer.replace(cand_values, inplace=True)
-df.Q61_cand17_persuade.replace(cand_values, inplace=True)
-
-
-# Q70
-df.Q70_mess13_fair.replace(mess_values, inplace=True)
-df.Q70_mess14_imprtnt.replace(mess_values, inplace=True)
-df.Q70_mess15_inform.replace(mess_values, inplace=True)
-
-# Q71
-df.Q71_cand1_strong.replace(cand_values, inplace=True)
-df.Q71_cand2_dishonest.replace(cand_reverse_values, inplace=True)
-df.Q71_cand3_aggressive.replace(cand_reverse_values, inplace=True)
-df.Q71_cand4_moral.replace(cand_values, inplace=True)
-df.Q71_cand6_weak.replace(cand_reverse_values, inplace=True)
-df.Q71_cand7_friends.replace(cand_values, inplace=True)
-df.Q71_cand13_relate.replace(cand_values, inplace=True)
-df.Q71_cand14_competent.replace(cand_values, inplace=True)
-df.Q71_cand15_votefor.replace(cand_values, inplace=True)
-df.Q71_cand16_volunteer.replace(cand_values, inplace=True)
-df.Q71_cand17_persuade.replace(cand_values, inplace=True)
+def label_codes(series, keys):
+    # position of every cell's label in keys, with len(keys) for missing
+    # cells and len(keys) + 1 for labels that are not in keys, plus a
+    # {label: count} dict of those unmapped labels. Only the distinct labels
+    # (the categories, or the factorized uniques of a plain column) are
+    # looked up, so the cells are only counted when some label is unmapped
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, labels = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        codes, labels = pd.factorize(series)
+    positions = pd.Index(keys).get_indexer(labels)
+    unmapped = {}
+    if (positions < 0).any():
+        counts = np.bincount(codes[codes >= 0], minlength=len(labels))
+        unmapped = {
+            label: int(count)
+            for label, position, count in zip(labels, positions, counts)
+            if position < 0 and count}
+        positions[positions < 0] = len(keys) + 1
+    return np.append(positions, len(keys))[codes], unmapped
+
+
+def recode_items(df, plan, unmapped=None):
+    # every column sharing a value map is recoded in one take of a lookup
+    # table over the (rows x columns) array of label codes, straight into
+    # ITEM_DTYPE values and missing-value masks. Labels missing from a map
+    # become NA and are added to unmapped as (column, label, count)
+    for values, columns in plan['recode']:
+        keys = list(values)
+        lookup = np.array(
+            [0 if values[k] is None else values[k] for k in keys] + [0, 0],
+            dtype=pd.api.types.pandas_dtype(ITEM_DTYPE).numpy_dtype)
+        missing = np.array([values[k] is None for k in keys] + [True, True])
+        codes = []
+        for column in columns:
+            column_codes, column_unmapped = label_codes(df[column], keys)
+            codes.append(column_codes)
+            if unmapped is not None:
+                unmapped.extend(
+                    (column, label, count)
+                    for label, count in column_unmapped.items())
+        codes = np.column_stack(codes)
+        data, mask = lookup[codes], missing[codes]
+
+        df[columns] = pd.DataFrame(
+            {column: pd.arrays.IntegerArray(data[:, j], mask[:, j])
+             for j, column in enumerate(columns)},
+            index=df.index)
+    return df
 
 
 # **Combining Test Conditions**
-# 
+#
 
 # In[5]:
 
 
-print('Creating EXP_Cond column...\n')
-if 'EXP_Cond' in df.columns:
-    print('EXP_Cond in DataFrame')
-else:
-    df.insert(
-        1,
-        column='EXP_Cond',
-        value=0)
-
-# Coding Experimental Condition
-df.loc[
-    (df['Q20_mess13_fair'] >= 1) |
-    (df['Q20_mess14_imprtnt'] >= 1) |
-    (df['Q20_mess15_inform'] >= 1) |
-    (df['Q21_cand1_strong'] >= 1) |
-    (df['Q21_cand2_dishonest'] >= 1) |
-    (df['Q21_cand3_aggressive'] >= 1) |
-    (df['Q21_cand4_moral'] >= 1) |
-    (df['Q21_cand6_weak'] >= 1) |
-    (df['Q21_cand7_friends'] >= 1) |
-    (df['Q21_cand13_relate'] >= 1) |
-    (df['Q21_cand14_competent'] >= 1) |
-    (df['Q21_cand15_votefor'] >= 1) |
-    (df['Q21_cand16_volunteer'] >= 1) |
-    (df['Q21_cand17_persuade'] >= 1), 
-    'EXP_Cond'] = 1
-
-
-df.loc[
-    (df['Q30_mess13_fair'] >= 1) |
-    (df['Q30_mess14_imprtnt'] >= 1) |
-    (df['Q30_mess15_inform'] >= 1) |
-    (df['Q31_cand1_strong'] >= 1) |
-    (df['Q31_cand2_dishonest'] >= 1) |
-    (df['Q31_cand3_aggressive'] >= 1) |
-    (df['Q31_cand4_moral'] >= 1) |
-    (df['Q31_cand6_weak'] >= 1) |
-    (df['Q31_cand7_friends'] >= 1) |
-    (df['Q31_cand13_relate'] >= 1) |
-    (df['Q31_cand14_competent'] >= 1) |
-    (df['Q31_cand15_votefor'] >= 1) |
-    (df['Q31_cand16_volunteer'] >= 1) |
-    (df['Q31_cand17_persuade'] >= 1), 
-    'EXP_Cond'] = 2
-
-
-df.loc[
-    (df['Q40_mess13_fair'] >= 1) |
-    (df['Q40_mess14_imprtnt'] >= 1) |
-    (df['Q40_mess15_inform'] >= 1) |
-    (df['Q41_cand1_strong'] >= 1) |
-    (df['Q41_cand2_dishonest'] >= 1) |
-    (df['Q41_cand3_aggressive'] >= 1) |
-    (df['Q41_cand4_moral'] >= 1) |
-    (df['Q41_cand6_weak'] >= 1) |
-    (df['Q41_cand7_friends'] >= 1) |
-    (df['Q41_cand13_relate'] >= 1) |
-    (df['Q41_cand14_competent'] >= 1) |
-    (df['Q41_cand15_votefor'] >= 1) |
-    (df['Q41_cand16_volunteer'] >= 1) |
-    (df['Q41_cand17_persuade'] >= 1), 
-    'EXP_Cond'] = 3
-
-
-df.loc[
-    (df['Q50_mess13_fair'] >= 1) |
-    (df['Q50_mess14_imprtnt'] >= 1) |
-    (df['Q50_mess15_inform'] >= 1) |
-    (df['Q51_cand1_strong'] >= 1) |
-    (df['Q51_cand2_dishonest'] >= 1) |
-    (df['Q51_cand3_aggressive'] >= 1) |
-    (df['Q51_cand4_moral'] >= 1) |
-    (df['Q51_cand6_weak'] >= 1) |
-    (df['Q51_cand7_friends'] >= 1) |
-    (df['Q51_cand13_relate'] >= 1) |
-    (df['Q51_cand14_competent'] >= 1) |
-    (df['Q51_cand15_votefor'] >= 1) |
-    (df['Q51_cand16_volunteer'] >= 1) |
-    (df['Q51_cand17_persuade'] >= 1), 
-    'EXP_Cond'] = 4
-
-
-df.loc[
-    (df['Q60_mess13_fair'] >= 1) |
-    (df['Q60_mess14_imprtnt'] >= 1) |
-    (df['Q60_mess15_inform'] >= 1) |
-    (df['Q61_cand1_strong'] >= 1) |
-    (df['Q61_cand2_dishonest'] >= 1) |
-    (df['Q61_cand3_aggressive'] >= 1) |
-    (df['Q61_cand4_moral'] >= 1) |
-    (df['Q61_cand6_weak'] >= 1) |
-    (df['Q61_cand7_friends'] >= 1) |
-    (df['Q61_cand13_relate'] >= 1) |
-    (df['Q61_cand14_competent'] >= 1) |
-    (df['Q61_cand15_votefor'] >= 1) |
-    (df['Q61_cand16_volunteer'] >= 1) |
-    (df['Q61_cand17_persuade'] >= 1), 
-    'EXP_Cond'] = 5
-
-
-df.loc[
-    (df['Q70_mess13_fair'] >= 1) |
-    (df['Q70_mess14_imprtnt'] >= 1) |
-    (df['Q70_mess15_inform'] >= 1) |
-    (df['Q71_cand1_strong'] >= 1) |
-    (df['Q71_cand2_dishonest'] >= 1) |
-    (df['Q71_cand3_aggressive'] >= 1) |
-    (df['Q71_cand4_moral'] >= 1) |
-    (df['Q71_cand6_weak'] >= 1) |
-    (df['Q71_cand7_friends'] >= 1) |
-    (df['Q71_cand13_relate'] >= 1) |
-    (df['Q71_cand14_competent'] >= 1) |
-    (df['Q71_cand15_votefor'] >= 1) |
-    (df['Q71_cand16_volunteer'] >= 1) |
-    (df['Q71_cand17_persuade'] >= 1), 
-    'EXP_Cond'] = 6
-
-
-
-
-# Human Readable Column
-print('Creating EXP_Cond_HR column...\n')
-if 'EXP_Cond_HR' in df.columns:
-    print('EXP_Cond_HR in DataFrame')
-else:
-    df.insert(
-        2,
-        column='EXP_Cond_HR',
-        value=None)
-
-
-df.loc[df['EXP_Cond'] == 1, 'EXP_Cond_HR'] = 'HE-CivilPositive'
-df.loc[df['EXP_Cond'] == 2, 'EXP_Cond_HR'] = 'HA-CivilPositive'
-df.loc[df['EXP_Cond'] == 3, 'EXP_Cond_HR'] = 'HE-CivilNegative'
-df.loc[df['EXP_Cond'] == 4, 'EXP_Cond_HR'] = 'HA-CivilNegative'
-df.loc[df['EXP_Cond'] == 5, 'EXP_Cond_HR'] = 'HE-Uncivil'
-df.loc[df['EXP_Cond'] == 6, 'EXP_Cond_HR'] = 'HA-Uncivil'
-df.loc[df['EXP_Cond'] == 0, 'EXP_Cond_HR'] = 'NonTest'
-
-
-print('Value Counts - Recoded')
-print(df.EXP_Cond.value_counts())
-print('\nHumanReadable')
-print(df.EXP_Cond_HR.value_counts())
+def stack_blocks(df, plan):
+    # (rows x blocks x items) int8 array of every condition block's recoded
+    # items, with 0 for missing answers; items are in the same order in
+    # every block
+    columns = [column for code, label, block in plan['conditions'] for column in block]
+    items = np.column_stack([
+        df[column].to_numpy(dtype='int8', na_value=0) for column in columns])
+    return items.reshape(len(df), len(plan['conditions']), len(plan['items']))
+
+
+def code_conditions(df, plan):
+    # a respondent belongs to the last block in which any item was answered;
+    # EXP_Cond_Blocks counts the answered blocks so respondents who saw more
+    # than one condition can be found
+    nontest_code, nontest_label = plan['nontest']
+    answered = (stack_blocks(df, plan) >= 1).any(axis=2)
+    n_blocks = answered.shape[1]
+    last = n_blocks - 1 - answered[:, ::-1].argmax(axis=1)
+    choice = np.where(answered.any(axis=1), last + 1, 0)
+
+    codes = [nontest_code] + [code for code, label, columns in plan['conditions']]
+    labels = [nontest_label] + [label for code, label, columns in plan['conditions']]
+    order = np.argsort(codes)
+
+    print('Creating EXP_Cond column...\n')
+    if 'EXP_Cond' in df.columns:
+        print('EXP_Cond in DataFrame')
+    else:
+        df.insert(
+            1,
+            column='EXP_Cond',
+            value=None)
+    df['EXP_Cond'] = pd.array(np.asarray(codes, dtype='int8')[choice], dtype=ITEM_DTYPE)
+
+    # Human Readable Column
+    print('Creating EXP_Cond_HR column...\n')
+    if 'EXP_Cond_HR' in df.columns:
+        print('EXP_Cond_HR in DataFrame')
+    else:
+        df.insert(
+            2,
+            column='EXP_Cond_HR',
+            value=None)
+    df['EXP_Cond_HR'] = pd.Categorical.from_codes(
+        np.argsort(order)[choice], categories=[labels[i] for i in order])
+
+    df['EXP_Cond_Blocks'] = pd.array(answered.sum(axis=1, dtype='int8'), dtype=ITEM_DTYPE)
+
+    print('Value Counts - Recoded')
+    print(df.EXP_Cond.value_counts())
+    print('\nHumanReadable')
+    print(df.EXP_Cond_HR.value_counts())
+    return df
 
 
 # ## Combining Conditions into Singular Variables
@@ -723,1156 +524,720 @@ print(df.EXP_Cond_HR.value_counts())
 # * cand16_volunteer
 # * cand17_persuade
 
-# **Message Coding**
-
 # In[6]:
 
 
-# message 13
-print('Creating mess13_fair column...\n')
-if 'mess13_fair' in df.columns:
-    print('mess13_fair in DataFrame')
-else:
-    df.insert(
-        5,
-        column='mess13_fair',
-        value=None)
-
-df.loc[
-    (df['Q20_mess13_fair'] == 1) |
-    (df['Q30_mess13_fair'] == 1) |
-    (df['Q40_mess13_fair'] == 1) |
-    (df['Q50_mess13_fair'] == 1) |
-    (df['Q60_mess13_fair'] == 1) |
-    (df['Q70_mess13_fair'] == 1), 
-    'mess13_fair'] = 1
-
-df.loc[
-    (df['Q20_mess13_fair'] == 2) |
-    (df['Q30_mess13_fair'] == 2) |
-    (df['Q40_mess13_fair'] == 2) |
-    (df['Q50_mess13_fair'] == 2) |
-    (df['Q60_mess13_fair'] == 2) |
-    (df['Q70_mess13_fair'] == 2), 
-    'mess13_fair'] = 2
-
-df.loc[
-    (df['Q20_mess13_fair'] == 3) |
-    (df['Q30_mess13_fair'] == 3) |
-    (df['Q40_mess13_fair'] == 3) |
-    (df['Q50_mess13_fair'] == 3) |
-    (df['Q60_mess13_fair'] == 3) |
-    (df['Q70_mess13_fair'] == 3), 
-    'mess13_fair'] = 3
-
-df.loc[
-    (df['Q20_mess13_fair'] == 4) |
-    (df['Q30_mess13_fair'] == 4) |
-    (df['Q40_mess13_fair'] == 4) |
-    (df['Q50_mess13_fair'] == 4) |
-    (df['Q60_mess13_fair'] == 4) |
-    (df['Q70_mess13_fair'] == 4), 
-    'mess13_fair'] = 4
-
-print(df['mess13_fair'].value_counts(dropna=False))
-
-
-
-
-# message 14
-print('Creating mess14_imprtnt column...\n')
-if 'mess14_imprtnt' in df.columns:
-    print('mess14_imprtnt in DataFrame')
-else:
-    df.insert(
-        5,
-        column='mess14_imprtnt',
-        value=None)
-
-# mess14_imprtnt
-df.loc[
-    (df['Q20_mess14_imprtnt'] == 1) |
-    (df['Q30_mess14_imprtnt'] == 1) |
-    (df['Q40_mess14_imprtnt'] == 1) |
-    (df['Q50_mess14_imprtnt'] == 1) |
-    (df['Q60_mess14_imprtnt'] == 1) |
-    (df['Q70_mess14_imprtnt'] == 1), 
-    'mess14_imprtnt'] = 1
-
-df.loc[
-    (df['Q20_mess14_imprtnt'] == 2) |
-    (df['Q30_mess14_imprtnt'] == 2) |
-    (df['Q40_mess14_imprtnt'] == 2) |
-    (df['Q50_mess14_imprtnt'] == 2) |
-    (df['Q60_mess14_imprtnt'] == 2) |
-    (df['Q70_mess14_imprtnt'] == 2), 
-    'mess14_imprtnt'] = 2
-
-df.loc[
-    (df['Q20_mess14_imprtnt'] == 3) |
-    (df['Q30_mess14_imprtnt'] == 3) |
-    (df['Q40_mess14_imprtnt'] == 3) |
-    (df['Q50_mess14_imprtnt'] == 3) |
-    (df['Q60_mess14_imprtnt'] == 3) |
-    (df['Q70_mess14_imprtnt'] == 3), 
-    'mess14_imprtnt'] = 3
-
-df.loc[
-    (df['Q20_mess14_imprtnt'] == 4) |
-    (df['Q30_mess14_imprtnt'] == 4) |
-    (df['Q40_mess14_imprtnt'] == 4) |
-    (df['Q50_mess14_imprtnt'] == 4) |
-    (df['Q60_mess14_imprtnt'] == 4) |
-    (df['Q70_mess14_imprtnt'] == 4), 
-    'mess14_imprtnt'] = 4
-
-
-print(df['mess14_imprtnt'].value_counts(dropna=False))
-
-
-
-# message 15
-print('Creating mess15_inform column...\n')
-if 'mess15_inform' in df.columns:
-    print('mess15_inform in DataFrame')
-else:
-    df.insert(
-        5,
-        column='mess15_inform',
-        value=None)
-
-# mess15_inform
-df.loc[
-    (df['Q20_mess15_inform'] == 1) |
-    (df['Q30_mess15_inform'] == 1) |
-    (df['Q40_mess15_inform'] == 1) |
-    (df['Q50_mess15_inform'] == 1) |
-    (df['Q60_mess15_inform'] == 1) |
-    (df['Q70_mess15_inform'] == 1), 
-    'mess15_inform'] = 1
-
-df.loc[
-    (df['Q20_mess15_inform'] == 2) |
-    (df['Q30_mess15_inform'] == 2) |
-    (df['Q40_mess15_inform'] == 2) |
-    (df['Q50_mess15_inform'] == 2) |
-    (df['Q60_mess15_inform'] == 2) |
-    (df['Q70_mess15_inform'] == 2), 
-    'mess15_inform'] = 2
-
-df.loc[
-    (df['Q20_mess15_inform'] == 3) |
-    (df['Q30_mess15_inform'] == 3) |
-    (df['Q40_mess15_inform'] == 3) |
-    (df['Q50_mess15_inform'] == 3) |
-    (df['Q60_mess15_inform'] == 3) |
-    (df['Q70_mess15_inform'] == 3), 
-    'mess15_inform'] = 3
-
-df.loc[
-    (df['Q20_mess15_inform'] == 4) |
-    (df['Q30_mess15_inform'] == 4) |
-    (df['Q40_mess15_inform'] == 4) |
-    (df['Q50_mess15_inform'] == 4) |
-    (df['Q60_mess15_inform'] == 4) |
-    (df['Q70_mess15_inform'] == 4), 
-    'mess15_inform'] = 4
-
-print(df['mess15_inform'].value_counts(dropna=False))
-
-
-# **Candidate Coding**
+def combine_conditions(df, plan):
+    # each unified item coalesces its six blocks: only one block is answered
+    # per respondent, so the highest valid level over the block axis of the
+    # stacked items is the answer from that block (and for the rare
+    # multi-block respondent, the same highest level as before)
+    items = stack_blocks(df, plan)
+    for k, (name, columns, levels) in enumerate(plan['combine']):
+        print('Creating {} column...\n'.format(name))
+        block = items[:, :, k]
+        combined = np.where(np.isin(block, levels), block, 0).max(axis=1)
+        df[name] = pd.arrays.IntegerArray(combined, combined == 0)
+    return df
+
+
+def long_table(df, plan):
+    # one row per answered block item: ResponseId, the EXP_Cond of the block
+    # the answer was given in, block type, item and its int8 value. Unanswered
+    # blocks are left out, so this holds one block's items per respondent
+    # instead of the six mostly empty copies in A1
+    items = stack_blocks(df, plan)
+    rows, blocks, positions = np.nonzero(items >= 1)
+    kinds = [kind for kind, name in plan['items']]
+    names = [name for kind, name in plan['items']]
+    block_types = ['message', 'candidate']
+    return pd.DataFrame({
+        'ResponseId': df['ResponseId'].to_numpy()[rows],
+        'EXP_Cond': np.asarray(
+            [code for code, label, columns in plan['conditions']],
+            dtype='int8')[blocks],
+        'block': pd.Categorical.from_codes(
+            np.asarray([block_types.index(kind) for kind in kinds],
+                       dtype='int8')[positions],
+            categories=block_types),
+        'item': pd.Categorical.from_codes(positions, categories=names),
+        'value': items[rows, blocks, positions],
+    })
+
+
+# **Composite Scales**
+#
+# Scale means (SDO and its Dominance / Anti-Egalitarianism and pro / con
+# halves, ideology, trust, message and candidate evaluation) are the mean of
+# the answered items, or missing when fewer than min_valid items were
+# answered. Items listed under a scale's reverse are scored as
+# (low + high) - value of the scale's range.
 
 # In[7]:
 
 
-print('Creating cand1_strong column...\n')
-if 'cand1_strong' in df.columns:
-    print('cand1_strong in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand1_strong',
-        value=None)
-
-# candidate strength
-df.loc[
-    (df['Q21_cand1_strong'] == 1) |
-    (df['Q31_cand1_strong'] == 1) |
-    (df['Q41_cand1_strong'] == 1) |
-    (df['Q51_cand1_strong'] == 1) |
-    (df['Q61_cand1_strong'] == 1) |
-    (df['Q71_cand1_strong'] == 1), 
-    'cand1_strong'] = 1
-
-df.loc[
-    (df['Q21_cand1_strong'] == 2) |
-    (df['Q31_cand1_strong'] == 2) |
-    (df['Q41_cand1_strong'] == 2) |
-    (df['Q51_cand1_strong'] == 2) |
-    (df['Q61_cand1_strong'] == 2) |
-    (df['Q71_cand1_strong'] == 2), 
-    'cand1_strong'] = 2
-
-df.loc[
-    (df['Q21_cand1_strong'] == 3) |
-    (df['Q31_cand1_strong'] == 3) |
-    (df['Q41_cand1_strong'] == 3) |
-    (df['Q51_cand1_strong'] == 3) |
-    (df['Q61_cand1_strong'] == 3) |
-    (df['Q71_cand1_strong'] == 3), 
-    'cand1_strong'] = 3
-
-df.loc[
-    (df['Q21_cand1_strong'] == 4) |
-    (df['Q31_cand1_strong'] == 4) |
-    (df['Q41_cand1_strong'] == 4) |
-    (df['Q51_cand1_strong'] == 4) |
-    (df['Q61_cand1_strong'] == 4) |
-    (df['Q71_cand1_strong'] == 4), 
-    'cand1_strong'] = 4
-
-df.loc[
-    (df['Q21_cand1_strong'] == 5) |
-    (df['Q31_cand1_strong'] == 5) |
-    (df['Q41_cand1_strong'] == 5) |
-    (df['Q51_cand1_strong'] == 5) |
-    (df['Q61_cand1_strong'] == 5) |
-    (df['Q71_cand1_strong'] == 5), 
-    'cand1_strong'] = 5
-
-df.loc[
-    (df['Q21_cand1_strong'] == 6) |
-    (df['Q31_cand1_strong'] == 6) |
-    (df['Q41_cand1_strong'] == 6) |
-    (df['Q51_cand1_strong'] == 6) |
-    (df['Q61_cand1_strong'] == 6) |
-    (df['Q71_cand1_strong'] == 6), 
-    'cand1_strong'] = 6
-
-df.loc[
-    (df['Q21_cand1_strong'] == 7) |
-    (df['Q31_cand1_strong'] == 7) |
-    (df['Q41_cand1_strong'] == 7) |
-    (df['Q51_cand1_strong'] == 7) |
-    (df['Q61_cand1_strong'] == 7) |
-    (df['Q71_cand1_strong'] == 7), 
-    'cand1_strong'] = 7
-
-
-
-# candidate dishonesty
-print('Creating cand2_dishonest column...\n')
-if 'cand2_dishonest' in df.columns:
-    print('cand2_dishonest in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand2_dishonest',
-        value=None)
-
-# cand2_dishonest
-df.loc[
-    (df['Q21_cand2_dishonest'] == 1) |
-    (df['Q31_cand2_dishonest'] == 1) |
-    (df['Q41_cand2_dishonest'] == 1) |
-    (df['Q51_cand2_dishonest'] == 1) |
-    (df['Q61_cand2_dishonest'] == 1) |
-    (df['Q71_cand2_dishonest'] == 1), 
-    'cand2_dishonest'] = 1
-
-df.loc[
-    (df['Q21_cand2_dishonest'] == 2) |
-    (df['Q31_cand2_dishonest'] == 2) |
-    (df['Q41_cand2_dishonest'] == 2) |
-    (df['Q51_cand2_dishonest'] == 2) |
-    (df['Q61_cand2_dishonest'] == 2) |
-    (df['Q71_cand2_dishonest'] == 2), 
-    'cand2_dishonest'] = 2
-
-df.loc[
-    (df['Q21_cand2_dishonest'] == 3) |
-    (df['Q31_cand2_dishonest'] == 3) |
-    (df['Q41_cand2_dishonest'] == 3) |
-    (df['Q51_cand2_dishonest'] == 3) |
-    (df['Q61_cand2_dishonest'] == 3) |
-    (df['Q71_cand2_dishonest'] == 3), 
-    'cand2_dishonest'] = 3
-
-df.loc[
-    (df['Q21_cand2_dishonest'] == 4) |
-    (df['Q31_cand2_dishonest'] == 4) |
-    (df['Q41_cand2_dishonest'] == 4) |
-    (df['Q51_cand2_dishonest'] == 4) |
-    (df['Q61_cand2_dishonest'] == 4) |
-    (df['Q71_cand2_dishonest'] == 4), 
-    'cand2_dishonest'] = 4
-
-df.loc[
-    (df['Q21_cand2_dishonest'] == 5) |
-    (df['Q31_cand2_dishonest'] == 5) |
-    (df['Q41_cand2_dishonest'] == 5) |
-    (df['Q51_cand2_dishonest'] == 5) |
-    (df['Q61_cand2_dishonest'] == 5) |
-    (df['Q71_cand2_dishonest'] == 5), 
-    'cand2_dishonest'] = 5
-
-df.loc[
-    (df['Q21_cand2_dishonest'] == 6) |
-    (df['Q31_cand2_dishonest'] == 6) |
-    (df['Q41_cand2_dishonest'] == 6) |
-    (df['Q51_cand2_dishonest'] == 6) |
-    (df['Q61_cand2_dishonest'] == 6) |
-    (df['Q71_cand2_dishonest'] == 6), 
-    'cand2_dishonest'] = 6
-
-df.loc[
-    (df['Q21_cand2_dishonest'] == 7) |
-    (df['Q31_cand2_dishonest'] == 7) |
-    (df['Q41_cand2_dishonest'] == 7) |
-    (df['Q51_cand2_dishonest'] == 7) |
-    (df['Q61_cand2_dishonest'] == 7) |
-    (df['Q71_cand2_dishonest'] == 7), 
-    'cand2_dishonest'] = 7
-
-
-# candidate aggression
-print('Creating cand3_aggressive column...\n')
-if 'cand3_aggressive' in df.columns:
-    print('cand3_aggressive in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand3_aggressive',
-        value=None)
-
-df.loc[
-    (df['Q21_cand3_aggressive'] == 1) |
-    (df['Q31_cand3_aggressive'] == 1) |
-    (df['Q41_cand3_aggressive'] == 1) |
-    (df['Q51_cand3_aggressive'] == 1) |
-    (df['Q61_cand3_aggressive'] == 1) |
-    (df['Q71_cand3_aggressive'] == 1), 
-    'cand3_aggressive'] = 1
-
-df.loc[
-    (df['Q21_cand3_aggressive'] == 2) |
-    (df['Q31_cand3_aggressive'] == 2) |
-    (df['Q41_cand3_aggressive'] == 2) |
-    (df['Q51_cand3_aggressive'] == 2) |
-    (df['Q61_cand3_aggressive'] == 2) |
-    (df['Q71_cand3_aggressive'] == 2), 
-    'cand3_aggressive'] = 2
-
-df.loc[
-    (df['Q21_cand3_aggressive'] == 3) |
-    (df['Q31_cand3_aggressive'] == 3) |
-    (df['Q41_cand3_aggressive'] == 3) |
-    (df['Q51_cand3_aggressive'] == 3) |
-    (df['Q61_cand3_aggressive'] == 3) |
-    (df['Q71_cand3_aggressive'] == 3), 
-    'cand3_aggressive'] = 3
-
-df.loc[
-    (df['Q21_cand3_aggressive'] == 4) |
-    (df['Q31_cand3_aggressive'] == 4) |
-    (df['Q41_cand3_aggressive'] == 4) |
-    (df['Q51_cand3_aggressive'] == 4) |
-    (df['Q61_cand3_aggressive'] == 4) |
-    (df['Q71_cand3_aggressive'] == 4), 
-    'cand3_aggressive'] = 4
-
-df.loc[
-    (df['Q21_cand3_aggressive'] == 5) |
-    (df['Q31_cand3_aggressive'] == 5) |
-    (df['Q41_cand3_aggressive'] == 5) |
-    (df['Q51_cand3_aggressive'] == 5) |
-    (df['Q61_cand3_aggressive'] == 5) |
-    (df['Q71_cand3_aggressive'] == 5), 
-    'cand3_aggressive'] = 5
-
-df.loc[
-    (df['Q21_cand3_aggressive'] == 6) |
-    (df['Q31_cand3_aggressive'] == 6) |
-    (df['Q41_cand3_aggressive'] == 6) |
-    (df['Q51_cand3_aggressive'] == 6) |
-    (df['Q61_cand3_aggressive'] == 6) |
-    (df['Q71_cand3_aggressive'] == 6), 
-    'cand3_aggressive'] = 6
-
-df.loc[
-    (df['Q21_cand3_aggressive'] == 7) |
-    (df['Q31_cand3_aggressive'] == 7) |
-    (df['Q41_cand3_aggressive'] == 7) |
-    (df['Q51_cand3_aggressive'] == 7) |
-    (df['Q61_cand3_aggressive'] == 7) |
-    (df['Q71_cand3_aggressive'] == 7), 
-    'cand3_aggressive'] = 7
-
-# candidate morality
-print('Creating cand4_moral column...\n')
-if 'cand4_moral' in df.columns:
-    print('cand4_moral in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand4_moral',
-        value=None)
-
-df.loc[
-    (df['Q21_cand4_moral'] == 1) |
-    (df['Q31_cand4_moral'] == 1) |
-    (df['Q41_cand4_moral'] == 1) |
-    (df['Q51_cand4_moral'] == 1) |
-    (df['Q61_cand4_moral'] == 1) |
-    (df['Q71_cand4_moral'] == 1), 
-    'cand4_moral'] = 1
-
-df.loc[
-    (df['Q21_cand4_moral'] == 2) |
-    (df['Q31_cand4_moral'] == 2) |
-    (df['Q41_cand4_moral'] == 2) |
-    (df['Q51_cand4_moral'] == 2) |
-    (df['Q61_cand4_moral'] == 2) |
-    (df['Q71_cand4_moral'] == 2), 
-    'cand4_moral'] = 2
-
-df.loc[
-    (df['Q21_cand4_moral'] == 3) |
-    (df['Q31_cand4_moral'] == 3) |
-    (df['Q41_cand4_moral'] == 3) |
-    (df['Q51_cand4_moral'] == 3) |
-    (df['Q61_cand4_moral'] == 3) |
-    (df['Q71_cand4_moral'] == 3), 
-    'cand4_moral'] = 3
-
-df.loc[
-    (df['Q21_cand4_moral'] == 4) |
-    (df['Q31_cand4_moral'] == 4) |
-    (df['Q41_cand4_moral'] == 4) |
-    (df['Q51_cand4_moral'] == 4) |
-    (df['Q61_cand4_moral'] == 4) |
-    (df['Q71_cand4_moral'] == 4), 
-    'cand4_moral'] = 4
-
-df.loc[
-    (df['Q21_cand4_moral'] == 5) |
-    (df['Q31_cand4_moral'] == 5) |
-    (df['Q41_cand4_moral'] == 5) |
-    (df['Q51_cand4_moral'] == 5) |
-    (df['Q61_cand4_moral'] == 5) |
-    (df['Q71_cand4_moral'] == 5), 
-    'cand4_moral'] = 5
-
-df.loc[
-    (df['Q21_cand4_moral'] == 6) |
-    (df['Q31_cand4_moral'] == 6) |
-    (df['Q41_cand4_moral'] == 6) |
-    (df['Q51_cand4_moral'] == 6) |
-    (df['Q61_cand4_moral'] == 6) |
-    (df['Q71_cand4_moral'] == 6), 
-    'cand4_moral'] = 6
-
-df.loc[
-    (df['Q21_cand4_moral'] == 7) |
-    (df['Q31_cand4_moral'] == 7) |
-    (df['Q41_cand4_moral'] == 7) |
-    (df['Q51_cand4_moral'] == 7) |
-    (df['Q61_cand4_moral'] == 7) |
-    (df['Q71_cand4_moral'] == 7), 
-    'cand4_moral'] = 7
-
-
-# candididate weakness
-print('Creating cand6_weak column...\n')
-if 'cand6_weak' in df.columns:
-    print('cand6_weak in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand6_weak',
-        value=None)
-
-df.loc[
-    (df['Q21_cand6_weak'] == 1) |
-    (df['Q31_cand6_weak'] == 1) |
-    (df['Q41_cand6_weak'] == 1) |
-    (df['Q51_cand6_weak'] == 1) |
-    (df['Q61_cand6_weak'] == 1) |
-    (df['Q71_cand6_weak'] == 1), 
-    'cand6_weak'] = 1
-
-df.loc[
-    (df['Q21_cand6_weak'] == 2) |
-    (df['Q31_cand6_weak'] == 2) |
-    (df['Q41_cand6_weak'] == 2) |
-    (df['Q51_cand6_weak'] == 2) |
-    (df['Q61_cand6_weak'] == 2) |
-    (df['Q71_cand6_weak'] == 2), 
-    'cand6_weak'] = 2
-
-df.loc[
-    (df['Q21_cand6_weak'] == 3) |
-    (df['Q31_cand6_weak'] == 3) |
-    (df['Q41_cand6_weak'] == 3) |
-    (df['Q51_cand6_weak'] == 3) |
-    (df['Q61_cand6_weak'] == 3) |
-    (df['Q71_cand6_weak'] == 3), 
-    'cand6_weak'] = 3
-
-df.loc[
-    (df['Q21_cand6_weak'] == 4) |
-    (df['Q31_cand6_weak'] == 4) |
-    (df['Q41_cand6_weak'] == 4) |
-    (df['Q51_cand6_weak'] == 4) |
-    (df['Q61_cand6_weak'] == 4) |
-    (df['Q71_cand6_weak'] == 4), 
-    'cand6_weak'] = 4
-
-df.loc[
-    (df['Q21_cand6_weak'] == 5) |
-    (df['Q31_cand6_weak'] == 5) |
-    (df['Q41_cand6_weak'] == 5) |
-    (df['Q51_cand6_weak'] == 5) |
-    (df['Q61_cand6_weak'] == 5) |
-    (df['Q71_cand6_weak'] == 5), 
-    'cand6_weak'] = 5
-
-df.loc[
-    (df['Q21_cand6_weak'] == 6) |
-    (df['Q31_cand6_weak'] == 6) |
-    (df['Q41_cand6_weak'] == 6) |
-    (df['Q51_cand6_weak'] == 6) |
-    (df['Q61_cand6_weak'] == 6) |
-    (df['Q71_cand6_weak'] == 6), 
-    'cand6_weak'] = 6
-
-df.loc[
-    (df['Q21_cand6_weak'] == 7) |
-    (df['Q31_cand6_weak'] == 7) |
-    (df['Q41_cand6_weak'] == 7) |
-    (df['Q51_cand6_weak'] == 7) |
-    (df['Q61_cand6_weak'] == 7) |
-    (df['Q71_cand6_weak'] == 7), 
-    'cand6_weak'] = 7
-
-
-# candidate friendship
-print('Creating cand7_friends column...\n')
-if 'cand7_friends' in df.columns:
-    print('cand7_friends in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand7_friends',
-        value=None)
-
-df.loc[
-    (df['Q21_cand7_friends'] == 1) |
-    (df['Q31_cand7_friends'] == 1) |
-    (df['Q41_cand7_friends'] == 1) |
-    (df['Q51_cand7_friends'] == 1) |
-    (df['Q61_cand7_friends'] == 1) |
-    (df['Q71_cand7_friends'] == 1), 
-    'cand7_friends'] = 1
-
-df.loc[
-    (df['Q21_cand7_friends'] == 2) |
-    (df['Q31_cand7_friends'] == 2) |
-    (df['Q41_cand7_friends'] == 2) |
-    (df['Q51_cand7_friends'] == 2) |
-    (df['Q61_cand7_friends'] == 2) |
-    (df['Q71_cand7_friends'] == 2), 
-    'cand7_friends'] = 2
-
-df.loc[
-    (df['Q21_cand7_friends'] == 3) |
-    (df['Q31_cand7_friends'] == 3) |
-    (df['Q41_cand7_friends'] == 3) |
-    (df['Q51_cand7_friends'] == 3) |
-    (df['Q61_cand7_friends'] == 3) |
-    (df['Q71_cand7_friends'] == 3), 
-    'cand7_friends'] = 3
-
-df.loc[
-    (df['Q21_cand7_friends'] == 4) |
-    (df['Q31_cand7_friends'] == 4) |
-    (df['Q41_cand7_friends'] == 4) |
-    (df['Q51_cand7_friends'] == 4) |
-    (df['Q61_cand7_friends'] == 4) |
-    (df['Q71_cand7_friends'] == 4), 
-    'cand7_friends'] = 4
-
-df.loc[
-    (df['Q21_cand7_friends'] == 5) |
-    (df['Q31_cand7_friends'] == 5) |
-    (df['Q41_cand7_friends'] == 5) |
-    (df['Q51_cand7_friends'] == 5) |
-    (df['Q61_cand7_friends'] == 5) |
-    (df['Q71_cand7_friends'] == 5), 
-    'cand7_friends'] = 5
-
-df.loc[
-    (df['Q21_cand7_friends'] == 6) |
-    (df['Q31_cand7_friends'] == 6) |
-    (df['Q41_cand7_friends'] == 6) |
-    (df['Q51_cand7_friends'] == 6) |
-    (df['Q61_cand7_friends'] == 6) |
-    (df['Q71_cand7_friends'] == 6), 
-    'cand7_friends'] = 6
-
-df.loc[
-    (df['Q21_cand7_friends'] == 7) |
-    (df['Q31_cand7_friends'] == 7) |
-    (df['Q41_cand7_friends'] == 7) |
-    (df['Q51_cand7_friends'] == 7) |
-    (df['Q61_cand7_friends'] == 7) |
-    (df['Q71_cand7_friends'] == 7), 
-    'cand7_friends'] = 7
-
-
-# candidate relatability
-print('Creating cand13_relate column...\n')
-if 'cand13_relate' in df.columns:
-    print('cand13_relate in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand13_relate',
-        value=None)
-
-df.loc[
-    (df['Q21_cand13_relate'] == 1) |
-    (df['Q31_cand13_relate'] == 1) |
-    (df['Q41_cand13_relate'] == 1) |
-    (df['Q51_cand13_relate'] == 1) |
-    (df['Q61_cand13_relate'] == 1) |
-    (df['Q71_cand13_relate'] == 1), 
-    'cand13_relate'] = 1
-
-df.loc[
-    (df['Q21_cand13_relate'] == 2) |
-    (df['Q31_cand13_relate'] == 2) |
-    (df['Q41_cand13_relate'] == 2) |
-    (df['Q51_cand13_relate'] == 2) |
-    (df['Q61_cand13_relate'] == 2) |
-    (df['Q71_cand13_relate'] == 2), 
-    'cand13_relate'] = 2
-
-df.loc[
-    (df['Q21_cand13_relate'] == 3) |
-    (df['Q31_cand13_relate'] == 3) |
-    (df['Q41_cand13_relate'] == 3) |
-    (df['Q51_cand13_relate'] == 3) |
-    (df['Q61_cand13_relate'] == 3) |
-    (df['Q71_cand13_relate'] == 3), 
-    'cand13_relate'] = 3
-
-df.loc[
-    (df['Q21_cand13_relate'] == 4) |
-    (df['Q31_cand13_relate'] == 4) |
-    (df['Q41_cand13_relate'] == 4) |
-    (df['Q51_cand13_relate'] == 4) |
-    (df['Q61_cand13_relate'] == 4) |
-    (df['Q71_cand13_relate'] == 4), 
-    'cand13_relate'] = 4
-
-df.loc[
-    (df['Q21_cand13_relate'] == 5) |
-    (df['Q31_cand13_relate'] == 5) |
-    (df['Q41_cand13_relate'] == 5) |
-    (df['Q51_cand13_relate'] == 5) |
-    (df['Q61_cand13_relate'] == 5) |
-    (df['Q71_cand13_relate'] == 5), 
-    'cand13_relate'] = 5
-
-df.loc[
-    (df['Q21_cand13_relate'] == 6) |
-    (df['Q31_cand13_relate'] == 6) |
-    (df['Q41_cand13_relate'] == 6) |
-    (df['Q51_cand13_relate'] == 6) |
-    (df['Q61_cand13_relate'] == 6) |
-    (df['Q71_cand13_relate'] == 6), 
-    'cand13_relate'] = 6
-
-df.loc[
-    (df['Q21_cand13_relate'] == 7) |
-    (df['Q31_cand13_relate'] == 7) |
-    (df['Q41_cand13_relate'] == 7) |
-    (df['Q51_cand13_relate'] == 7) |
-    (df['Q61_cand13_relate'] == 7) |
-    (df['Q71_cand13_relate'] == 7), 
-    'cand13_relate'] = 7
-
-
-# candidate competence
-print('Creating cand14_competent column...\n')
-if 'cand14_competent' in df.columns:
-    print('cand14_competent in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand14_competent',
-        value=None)
-
-df.loc[
-    (df['Q21_cand14_competent'] == 1) |
-    (df['Q31_cand14_competent'] == 1) |
-    (df['Q41_cand14_competent'] == 1) |
-    (df['Q51_cand14_competent'] == 1) |
-    (df['Q61_cand14_competent'] == 1) |
-    (df['Q71_cand14_competent'] == 1), 
-    'cand14_competent'] = 1
-
-df.loc[
-    (df['Q21_cand14_competent'] == 2) |
-    (df['Q31_cand14_competent'] == 2) |
-    (df['Q41_cand14_competent'] == 2) |
-    (df['Q51_cand14_competent'] == 2) |
-    (df['Q61_cand14_competent'] == 2) |
-    (df['Q71_cand14_competent'] == 2), 
-    'cand14_competent'] = 2
-
-df.loc[
-    (df['Q21_cand14_competent'] == 3) |
-    (df['Q31_cand14_competent'] == 3) |
-    (df['Q41_cand14_competent'] == 3) |
-    (df['Q51_cand14_competent'] == 3) |
-    (df['Q61_cand14_competent'] == 3) |
-    (df['Q71_cand14_competent'] == 3), 
-    'cand14_competent'] = 3
-
-df.loc[
-    (df['Q21_cand14_competent'] == 4) |
-    (df['Q31_cand14_competent'] == 4) |
-    (df['Q41_cand14_competent'] == 4) |
-    (df['Q51_cand14_competent'] == 4) |
-    (df['Q61_cand14_competent'] == 4) |
-    (df['Q71_cand14_competent'] == 4), 
-    'cand14_competent'] = 4
-
-df.loc[
-    (df['Q21_cand14_competent'] == 5) |
-    (df['Q31_cand14_competent'] == 5) |
-    (df['Q41_cand14_competent'] == 5) |
-    (df['Q51_cand14_competent'] == 5) |
-    (df['Q61_cand14_competent'] == 5) |
-    (df['Q71_cand14_competent'] == 5), 
-    'cand14_competent'] = 5
-
-df.loc[
-    (df['Q21_cand14_competent'] == 6) |
-    (df['Q31_cand14_competent'] == 6) |
-    (df['Q41_cand14_competent'] == 6) |
-    (df['Q51_cand14_competent'] == 6) |
-    (df['Q61_cand14_competent'] == 6) |
-    (df['Q71_cand14_competent'] == 6), 
-    'cand14_competent'] = 6
-
-df.loc[
-    (df['Q21_cand14_competent'] == 7) |
-    (df['Q31_cand14_competent'] == 7) |
-    (df['Q41_cand14_competent'] == 7) |
-    (df['Q51_cand14_competent'] == 7) |
-    (df['Q61_cand14_competent'] == 7) |
-    (df['Q71_cand14_competent'] == 7), 
-    'cand14_competent'] = 7
-
-
-# candidate - vote for
-print('Creating cand15_votefor column...\n')
-if 'cand15_votefor' in df.columns:
-    print('cand15_votefor in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand15_votefor',
-        value=None)
-
-df.loc[
-    (df['Q21_cand15_votefor'] == 1) |
-    (df['Q31_cand15_votefor'] == 1) |
-    (df['Q41_cand15_votefor'] == 1) |
-    (df['Q51_cand15_votefor'] == 1) |
-    (df['Q61_cand15_votefor'] == 1) |
-    (df['Q71_cand15_votefor'] == 1), 
-    'cand15_votefor'] = 1
-
-df.loc[
-    (df['Q21_cand15_votefor'] == 2) |
-    (df['Q31_cand15_votefor'] == 2) |
-    (df['Q41_cand15_votefor'] == 2) |
-    (df['Q51_cand15_votefor'] == 2) |
-    (df['Q61_cand15_votefor'] == 2) |
-    (df['Q71_cand15_votefor'] == 2), 
-    'cand15_votefor'] = 2
-
-df.loc[
-    (df['Q21_cand15_votefor'] == 3) |
-    (df['Q31_cand15_votefor'] == 3) |
-    (df['Q41_cand15_votefor'] == 3) |
-    (df['Q51_cand15_votefor'] == 3) |
-    (df['Q61_cand15_votefor'] == 3) |
-    (df['Q71_cand15_votefor'] == 3), 
-    'cand15_votefor'] = 3
-
-df.loc[
-    (df['Q21_cand15_votefor'] == 4) |
-    (df['Q31_cand15_votefor'] == 4) |
-    (df['Q41_cand15_votefor'] == 4) |
-    (df['Q51_cand15_votefor'] == 4) |
-    (df['Q61_cand15_votefor'] == 4) |
-    (df['Q71_cand15_votefor'] == 4), 
-    'cand15_votefor'] = 4
-
-df.loc[
-    (df['Q21_cand15_votefor'] == 5) |
-    (df['Q31_cand15_votefor'] == 5) |
-    (df['Q41_cand15_votefor'] == 5) |
-    (df['Q51_cand15_votefor'] == 5) |
-    (df['Q61_cand15_votefor'] == 5) |
-    (df['Q71_cand15_votefor'] == 5), 
-    'cand15_votefor'] = 5
-
-df.loc[
-    (df['Q21_cand15_votefor'] == 6) |
-    (df['Q31_cand15_votefor'] == 6) |
-    (df['Q41_cand15_votefor'] == 6) |
-    (df['Q51_cand15_votefor'] == 6) |
-    (df['Q61_cand15_votefor'] == 6) |
-    (df['Q71_cand15_votefor'] == 6), 
-    'cand15_votefor'] = 6
-
-df.loc[
-    (df['Q21_cand15_votefor'] == 7) |
-    (df['Q31_cand15_votefor'] == 7) |
-    (df['Q41_cand15_votefor'] == 7) |
-    (df['Q51_cand15_votefor'] == 7) |
-    (df['Q61_cand15_votefor'] == 7) |
-    (df['Q71_cand15_votefor'] == 7), 
-    'cand15_votefor'] = 7
-
-
-# candidate - volunteer
-print('Creating cand16_volunteer column...\n')
-if 'cand16_volunteer' in df.columns:
-    print('cand16_volunteer in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand16_volunteer',
-        value=None)
-
-df.loc[
-    (df['Q21_cand16_volunteer'] == 1) |
-    (df['Q31_cand16_volunteer'] == 1) |
-    (df['Q41_cand16_volunteer'] == 1) |
-    (df['Q51_cand16_volunteer'] == 1) |
-    (df['Q61_cand16_volunteer'] == 1) |
-    (df['Q71_cand16_volunteer'] == 1), 
-    'cand16_volunteer'] = 1
-
-df.loc[
-    (df['Q21_cand16_volunteer'] == 2) |
-    (df['Q31_cand16_volunteer'] == 2) |
-    (df['Q41_cand16_volunteer'] == 2) |
-    (df['Q51_cand16_volunteer'] == 2) |
-    (df['Q61_cand16_volunteer'] == 2) |
-    (df['Q71_cand16_volunteer'] == 2), 
-    'cand16_volunteer'] = 2
-
-df.loc[
-    (df['Q21_cand16_volunteer'] == 3) |
-    (df['Q31_cand16_volunteer'] == 3) |
-    (df['Q41_cand16_volunteer'] == 3) |
-    (df['Q51_cand16_volunteer'] == 3) |
-    (df['Q61_cand16_volunteer'] == 3) |
-    (df['Q71_cand16_volunteer'] == 3), 
-    'cand16_volunteer'] = 3
-
-df.loc[
-    (df['Q21_cand16_volunteer'] == 4) |
-    (df['Q31_cand16_volunteer'] == 4) |
-    (df['Q41_cand16_volunteer'] == 4) |
-    (df['Q51_cand16_volunteer'] == 4) |
-    (df['Q61_cand16_volunteer'] == 4) |
-    (df['Q71_cand16_volunteer'] == 4), 
-    'cand16_volunteer'] = 4
-
-df.loc[
-    (df['Q21_cand16_volunteer'] == 5) |
-    (df['Q31_cand16_volunteer'] == 5) |
-    (df['Q41_cand16_volunteer'] == 5) |
-    (df['Q51_cand16_volunteer'] == 5) |
-    (df['Q61_cand16_volunteer'] == 5) |
-    (df['Q71_cand16_volunteer'] == 5), 
-    'cand16_volunteer'] = 5
-
-df.loc[
-    (df['Q21_cand16_volunteer'] == 6) |
-    (df['Q31_cand16_volunteer'] == 6) |
-    (df['Q41_cand16_volunteer'] == 6) |
-    (df['Q51_cand16_volunteer'] == 6) |
-    (df['Q61_cand16_volunteer'] == 6) |
-    (df['Q71_cand16_volunteer'] == 6), 
-    'cand16_volunteer'] = 6
-
-df.loc[
-    (df['Q21_cand16_volunteer'] == 7) |
-    (df['Q31_cand16_volunteer'] == 7) |
-    (df['Q41_cand16_volunteer'] == 7) |
-    (df['Q51_cand16_volunteer'] == 7) |
-    (df['Q61_cand16_volunteer'] == 7) |
-    (df['Q71_cand16_volunteer'] == 7), 
-    'cand16_volunteer'] = 7
-
-
-# candidate persuasion
-print('Creating cand17_persuade column...\n')
-if 'cand17_persuade' in df.columns:
-    print('cand17_persuade in DataFrame')
-else:
-    df.insert(
-        5,
-        column='cand17_persuade',
-        value=None)
-
-df.loc[
-    (df['Q21_cand17_persuade'] == 1) |
-    (df['Q31_cand17_persuade'] == 1) |
-    (df['Q41_cand17_persuade'] == 1) |
-    (df['Q51_cand17_persuade'] == 1) |
-    (df['Q61_cand17_persuade'] == 1) |
-    (df['Q71_cand17_persuade'] == 1), 
-    'cand17_persuade'] = 1
-
-df.loc[
-    (df['Q21_cand17_persuade'] == 2) |
-    (df['Q31_cand17_persuade'] == 2) |
-    (df['Q41_cand17_persuade'] == 2) |
-    (df['Q51_cand17_persuade'] == 2) |
-    (df['Q61_cand17_persuade'] == 2) |
-    (df['Q71_cand17_persuade'] == 2), 
-    'cand17_persuade'] = 2
-
-df.loc[
-    (df['Q21_cand17_persuade'] == 3) |
-    (df['Q31_cand17_persuade'] == 3) |
-    (df['Q41_cand17_persuade'] == 3) |
-    (df['Q51_cand17_persuade'] == 3) |
-    (df['Q61_cand17_persuade'] == 3) |
-    (df['Q71_cand17_persuade'] == 3), 
-    'cand17_persuade'] = 3
-
-df.loc[
-    (df['Q21_cand17_persuade'] == 4) |
-    (df['Q31_cand17_persuade'] == 4) |
-    (df['Q41_cand17_persuade'] == 4) |
-    (df['Q51_cand17_persuade'] == 4) |
-    (df['Q61_cand17_persuade'] == 4) |
-    (df['Q71_cand17_persuade'] == 4), 
-    'cand17_persuade'] = 4
-
-df.loc[
-    (df['Q21_cand17_persuade'] == 5) |
-    (df['Q31_cand17_persuade'] == 5) |
-    (df['Q41_cand17_persuade'] == 5) |
-    (df['Q51_cand17_persuade'] == 5) |
-    (df['Q61_cand17_persuade'] == 5) |
-    (df['Q71_cand17_persuade'] == 5), 
-    'cand17_persuade'] = 5
-
-df.loc[
-    (df['Q21_cand17_persuade'] == 6) |
-    (df['Q31_cand17_persuade'] == 6) |
-    (df['Q41_cand17_persuade'] == 6) |
-    (df['Q51_cand17_persuade'] == 6) |
-    (df['Q61_cand17_persuade'] == 6) |
-    (df['Q71_cand17_persuade'] == 6), 
-    'cand17_persuade'] = 6
-
-df.loc[
-    (df['Q21_cand17_persuade'] == 7) |
-    (df['Q31_cand17_persuade'] == 7) |
-    (df['Q41_cand17_persuade'] == 7) |
-    (df['Q51_cand17_persuade'] == 7) |
-    (df['Q61_cand17_persuade'] == 7) |
-    (df['Q71_cand17_persuade'] == 7), 
-    'cand17_persuade'] = 7
-
+def score_scales(df, plan):
+    # one pass over the (rows x scale items) matrix: the answered counts and
+    # the item sums of every scale are each a single product with the weights
+    scales = plan['scales']
+    items = np.column_stack([
+        df[column].to_numpy(dtype='float32', na_value=np.nan)
+        for column, offset in scales['columns']])
+    offsets = np.array([offset for column, offset in scales['columns']], dtype='float32')
+    items = np.where(offsets > 0, offsets - items, items)
+    answered = ~np.isnan(items)
+    counts = answered.astype('float32') @ scales['weights']
+    sums = np.where(answered, items, 0) @ scales['weights']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+    means[counts < scales['min_valid']] = np.nan
+    for j, name in enumerate(scales['names']):
+        print('Creating {} column...\n'.format(name))
+        df[name] = means[:, j]
+    return df
+
+
+# **Scale Segments**
+#
+# A segment splits a scale (e.g. High / Low SDO) at fixed cutpoints, or at
+# quantiles of the scale taken over the whole frame or separately within each
+# value of a by column (e.g. EXP_Cond). A value equal to a cutpoint falls in
+# the lower segment. Quantiles are always taken over the whole data: --batch
+# and --chunksize runs take them in a first pass over every export or chunk,
+# and --incremental runs reuse the cutpoints saved by the first full run.
 
 # In[8]:
 
 
-df_all = df.loc[
-    :, ['ResponseId',
-        'Age',
-        'Ethnicity',
-        'Sex',
-        'EXP_Cond',
-        'EXP_Cond_HR',
-        'sdo1_Pro_Trait_Dom1',
-        'sdo13_Pro_Trait_Dom2',
-        'sdo6_Con_Trait_Dom2',
-        'sdo2_Con_Trait_Dom1',
-        'sdo7_Pro_Trait_AntiEgal1',
-        'sdo3_Pro_Trait_AntiEgal2',
-        'sdo4_Con_Trait_AntiEgal2',
-        'sdo14_Con_Trait_AntiEgal1',
-        'ideol2_social',
-        'ideol4_econ',
-        'ideol3_self',
-        'trust13_officials',
-        'trust6_nocare',
-        'trust2_nosay',
-        'pol_interest',
-        'pol_vote',
-        'cand17_persuade',
-        'cand16_volunteer',
-        'cand15_votefor',
-        'cand14_competent',
-        'cand13_relate',
-        'cand7_friends',
-        'cand6_weak',
-        'cand4_moral',
-        'cand3_aggressive',
-        'cand2_dishonest',
-        'cand1_strong',
-        'mess15_inform',
-        'mess14_imprtnt',
-        'mess13_fair',
-        'Q20_mess14_imprtnt',
-        'Q20_mess15_inform',
-        'Q20_mess13_fair',
-        'Q21_cand1_strong',
-        'Q21_cand13_relate',
-        'Q21_cand6_weak',
-        'Q21_cand2_dishonest',
-        'Q21_cand7_friends',
-        'Q21_cand3_aggressive',
-        'Q21_cand4_moral',
-        'Q21_cand14_competent',
-        'Q21_cand15_votefor',
-        'Q21_cand16_volunteer',
-        'Q21_cand17_persuade',
-        'Q30_mess14_imprtnt',
-        'Q30_mess15_inform',
-        'Q30_mess13_fair',
-        'Q31_cand1_strong',
-        'Q31_cand13_relate',
-        'Q31_cand6_weak',
-        'Q31_cand2_dishonest',
-        'Q31_cand7_friends',
-        'Q31_cand3_aggressive',
-        'Q31_cand4_moral',
-        'Q31_cand14_competent',
-        'Q31_cand15_votefor',
-        'Q31_cand16_volunteer',
-        'Q31_cand17_persuade',
-        'Q40_mess14_imprtnt',
-        'Q40_mess15_inform',
-        'Q40_mess13_fair',
-        'Q41_cand1_strong',
-        'Q41_cand13_relate',
-        'Q41_cand6_weak',
-        'Q41_cand2_dishonest',
-        'Q41_cand7_friends',
-        'Q41_cand3_aggressive',
-        'Q41_cand4_moral',
-        'Q41_cand14_competent',
-        'Q41_cand15_votefor',
-        'Q41_cand16_volunteer',
-        'Q41_cand17_persuade',
-        'Q50_mess14_imprtnt',
-        'Q50_mess15_inform',
-        'Q50_mess13_fair',
-        'Q51_cand1_strong',
-        'Q51_cand13_relate',
-        'Q51_cand6_weak',
-        'Q51_cand2_dishonest',
-        'Q51_cand7_friends',
-        'Q51_cand3_aggressive',
-        'Q51_cand4_moral',
-        'Q51_cand14_competent',
-        'Q51_cand15_votefor',
-        'Q51_cand16_volunteer',
-        'Q51_cand17_persuade',
-        'Q60_mess14_imprtnt',
-        'Q60_mess15_inform',
-        'Q60_mess13_fair',
-        'Q61_cand1_strong',
-        'Q61_cand13_relate',
-        'Q61_cand6_weak',
-        'Q61_cand2_dishonest',
-        'Q61_cand7_friends',
-        'Q61_cand3_aggressive',
-        'Q61_cand4_moral',
-        'Q61_cand14_competent',
-        'Q61_cand15_votefor',
-        'Q61_cand16_volunteer',
-        'Q61_cand17_persuade',
-        'Q70_mess14_imprtnt',
-        'Q70_mess15_inform',
-        'Q70_mess13_fair',
-        'Q71_cand1_strong',
-        'Q71_cand13_relate',
-        'Q71_cand6_weak',
-        'Q71_cand2_dishonest',
-        'Q71_cand7_friends',
-        'Q71_cand3_aggressive',
-        'Q71_cand4_moral',
-        'Q71_cand14_competent',
-        'Q71_cand15_votefor',
-        'Q71_cand16_volunteer',
-        'Q71_cand17_persuade'
-       ]]
-
-df_all.to_csv('A1-SDO_Campaigns_All.csv', index=False)
-
+def quantile_cutpoints(values, quantiles):
+    # linearly interpolated quantiles (as np.quantile) of the non-missing
+    # values, found by partial sorting around the needed ranks only
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return np.full(len(quantiles), np.nan)
+    positions = np.asarray(quantiles, dtype='float64') * (len(values) - 1)
+    lower = np.floor(positions).astype('int64')
+    upper = np.ceil(positions).astype('int64')
+    values = np.partition(values, np.unique(np.concatenate([lower, upper])))
+    return values[lower] + (values[upper] - values[lower]) * (positions - lower)
+
+
+def segment_scales(df, plan, cutpoints=None):
+    # cutpoints is a {segment: {group: cutpoints}} dict; quantile cutpoints
+    # already in it (taken over the whole data, or saved by an earlier run)
+    # are used as they are, and the ones computed from df are added to it
+    for segment in plan['segments']:
+        name = segment['name']
+        print('Creating {} column...\n'.format(name))
+        values = df[segment['scale']].to_numpy(dtype='float64', na_value=np.nan)
+        if segment.get('by') is None:
+            groups = [('All', np.ones(len(df), dtype=bool))]
+        else:
+            by = df[segment['by']]
+            groups = [(key, (by == key).to_numpy(dtype=bool, na_value=False))
+                      for key in sorted(by.dropna().unique())]
+
+        saved = {}
+        if cutpoints is not None and 'cutpoints' not in segment:
+            saved = cutpoints.setdefault(name, {})
+        codes = np.full(len(df), -1, dtype='int8')
+        for key, mask in groups:
+            if 'cutpoints' in segment:
+                points = np.asarray(segment['cutpoints'], dtype='float64')
+            elif str(key) in saved:
+                points = np.asarray(saved[str(key)], dtype='float64')
+            else:
+                points = quantile_cutpoints(values[mask], segment['quantiles'])
+                saved[str(key)] = points.tolist()
+            print('{} cutpoints ({}): {}'.format(
+                name, key, ', '.join('{:.3f}'.format(c) for c in points)))
+            codes[mask] = np.searchsorted(points, values[mask], side='left')
+        codes[np.isnan(values)] = -1
+        df[name] = pd.Categorical.from_codes(codes, categories=segment['labels'])
+        print(df[name].value_counts(), '\n')
+    return df
+
+
+def quantile_segments(plan):
+    return any('cutpoints' not in segment for segment in plan['segments'])
+
+
+def segment_columns(plan):
+    # the scale and by columns every segment is computed from
+    columns = []
+    for segment in plan['segments']:
+        columns.append(segment['scale'])
+        if segment.get('by') is not None:
+            columns.append(segment['by'])
+    return list(dict.fromkeys(columns))
+
+
+def report_cutpoints(cutpoints):
+    for name, groups in cutpoints.items():
+        for key, points in groups.items():
+            print('{} cutpoints ({}): {}'.format(
+                name, key, ', '.join('{:.3f}'.format(c) for c in points)))
+
+
+# **Aggregate Cube**
+#
+# Counts, sums and sums of squares of every cube outcome, plus a histogram of
+# each item over its 1..levels codes, for every non-empty cell of the cube
+# dimensions (EXP_Cond_HR x Sex x Ethnicity x age band). Missing dimension
+# values are a cell of their own. Every statistic is additive, so chunks and
+# appended responses are merged by summing, and rollup answers any coarser
+# grouping (means, SDs and distributions) from the cube alone.
 
 # In[9]:
 
 
-df_filter = df.loc[
-    :, ['ResponseId',
-        'Age',
-        'Ethnicity',
-        'Sex',
-        'EXP_Cond',
-        'EXP_Cond_HR',
-        'sdo1_Pro_Trait_Dom1',
-        'sdo13_Pro_Trait_Dom2',
-        'sdo6_Con_Trait_Dom2',
-        'sdo2_Con_Trait_Dom1',
-        'sdo7_Pro_Trait_AntiEgal1',
-        'sdo3_Pro_Trait_AntiEgal2',
-        'sdo4_Con_Trait_AntiEgal2',
-        'sdo14_Con_Trait_AntiEgal1',
-        'ideol2_social',
-        'ideol4_econ',
-        'ideol3_self',
-        'trust13_officials',
-        'trust6_nocare',
-        'trust2_nosay',
-        'pol_interest',
-        'pol_vote',
-        'cand17_persuade',
-        'cand16_volunteer',
-        'cand15_votefor',
-        'cand14_competent',
-        'cand13_relate',
-        'cand7_friends',
-        'cand6_weak',
-        'cand4_moral',
-        'cand3_aggressive',
-        'cand2_dishonest',
-        'cand1_strong',
-        'mess15_inform',
-        'mess14_imprtnt',
-        'mess13_fair'
-       ]]
-
-df_filter.to_csv('A2-SDO_Campaigns_filter.csv', index=False)
+def build_cube(df, plan):
+    cube = plan['cube']
+    codes, labels = [], []
+    for dim in cube['dimensions']:
+        if dim in cube['bands']:
+            band = cube['bands'][dim]
+            values = df[band['column']].to_numpy(dtype='float64', na_value=np.nan)
+            code = np.searchsorted(band['edges'], values, side='right')
+            code[np.isnan(values)] = -1
+            levels = list(band['labels'])
+        else:
+            code, levels = pd.factorize(df[dim], sort=True)
+            levels = list(levels)
+        codes.append(np.where(code < 0, len(levels), code))
+        labels.append(np.array(levels + [np.nan], dtype=object))
+
+    # every row's cell as one integer, so each statistic is one bincount
+    shape = [len(levels) for levels in labels]
+    cell = np.ravel_multi_index(codes, shape)
+    n_cells = int(np.prod(shape))
+    rows = np.bincount(cell, minlength=n_cells)
+    used = np.flatnonzero(rows)
+    index = np.unravel_index(used, shape)
+
+    out = {dim: labels[i][index[i]] for i, dim in enumerate(cube['dimensions'])}
+    out['rows'] = rows[used]
+    for outcome in cube['outcomes']:
+        values = df[outcome].to_numpy(dtype='float64', na_value=np.nan)
+        answered = ~np.isnan(values)
+        values, where = values[answered], cell[answered]
+        out[outcome + '_n'] = np.bincount(where, minlength=n_cells)[used]
+        out[outcome + '_sum'] = np.bincount(where, weights=values, minlength=n_cells)[used]
+        out[outcome + '_sumsq'] = np.bincount(
+            where, weights=values ** 2, minlength=n_cells)[used]
+    levels = cube['levels']
+    for outcome in cube['histograms']:
+        values = df[outcome].to_numpy(dtype='int64', na_value=0)
+        valid = (values >= 1) & (values <= levels)
+        counts = np.bincount(
+            cell[valid] * levels + values[valid] - 1,
+            minlength=n_cells * levels).reshape(n_cells, levels)[used]
+        for level in range(levels):
+            out['{}_h{}'.format(outcome, level + 1)] = counts[:, level]
+    return pd.DataFrame(out)
+
+
+def merge_cubes(cubes, plan):
+    # sums the statistics of cubes built over different rows
+    sums = (pd.concat(cubes, ignore_index=True)
+            .groupby(plan['cube']['dimensions'], dropna=False, sort=True)
+            .sum())
+    return pd.concat([sums.index.to_frame(index=False),
+                      sums.reset_index(drop=True)], axis=1)
+
+
+def write_cube(cube, plan, append=False):
+    # every cube goes through merge_cubes, so A4 lists its cells in the same
+    # (sorted label) order whether it was built in one pass or merged
+    cubes = [cube]
+    if append and os.path.exists(CUBE_FILE):
+        cubes.insert(0, pd.read_csv(CUBE_FILE))
+    merge_cubes(cubes, plan).to_csv(CUBE_FILE, index=False)
+
+
+def rollup(cube, dimensions, outcome):
+    # n, mean, SD and level distribution of one outcome for every combination
+    # of the given dimensions (an empty list for the whole sample)
+    columns = [c for c in cube.columns if c.startswith(outcome + '_')]
+    if dimensions:
+        cells = cube.groupby(dimensions, dropna=False, sort=True)[columns].sum()
+    else:
+        cells = cube[columns].sum().to_frame().T
+    n = cells[outcome + '_n']
+    total = cells[outcome + '_sum']
+    out = pd.DataFrame({
+        'n': n,
+        'mean': total / n,
+        'sd': np.sqrt((cells[outcome + '_sumsq'] - total ** 2 / n) / (n - 1)),
+    })
+    histogram = [c for c in columns if c.startswith(outcome + '_h')]
+    if histogram:
+        out = out.join(cells[histogram].div(n, axis=0).rename(
+            columns=lambda c: 'p' + c[len(outcome) + 2:]))
+    return out
+
+
+# **Running the Pipeline**
+
+# In[10]:
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    # silences the per-stage printing for streamed chunks and batch workers
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def process(df, plan, verbose=True, unmapped=None, cutpoints=None):
+    # runs one ingested frame (the whole export or a single chunk of it)
+    # through every stage; returns the frame and the number of respondents
+    # who answered more than one condition block
+    with quiet(not verbose):
+        df = rename_columns(df, plan)
+        df = clean_text(df, plan)
+        df = recode_items(df, plan, unmapped=unmapped)
+        df = code_conditions(df, plan)
+        df = combine_conditions(df, plan)
+        df = score_scales(df, plan)
+        df = segment_scales(df, plan, cutpoints=cutpoints)
+    return df, int((df['EXP_Cond_Blocks'] > 1).sum())
+
+
+def columnar_path(csv_file, columnar):
+    return os.path.splitext(csv_file)[0] + COLUMNAR_FORMATS[columnar]
+
+
+def write_columnar(df, columns, path, columnar, append=False,
+                   chunksize=CSV_CHUNKSIZE):
+    # adds one part file to the dataset directory at path (a fresh write
+    # replaces the directory). Parts keep the Int8 items, float32 scales and
+    # categorical labels, and are read back with pd.read_parquet(path,
+    # columns=[...]) or pyarrow.dataset, which only read the requested
+    # columns. Parquet parts are zstd-compressed for size; Feather parts are
+    # left uncompressed so feather.read_table(part, columns=[...],
+    # memory_map=True) maps the requested columns without copying them.
+    # Like write_csv, only one row slice of df is converted to Arrow at a
+    # time and streamed into the part file
+    import pyarrow as pa
+    from pyarrow import ipc, parquet
+
+    if not append and os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path, exist_ok=True)
+    part = os.path.join(path, 'part-{:05d}{}'.format(
+        len(os.listdir(path)), COLUMNAR_FORMATS[columnar]))
+
+    # the part's schema comes from the first slice, with text columns that
+    # are empty there typed as strings so later slices can fill them
+    table = pa.Table.from_pandas(
+        df.iloc[:chunksize], columns=columns, preserve_index=False)
+    schema = pa.schema(
+        [field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+         for field in table.schema], metadata=table.schema.metadata)
+    if columnar == 'parquet':
+        writer = parquet.ParquetWriter(part, schema, compression='zstd')
+    else:
+        writer = ipc.new_file(
+            part, schema, options=ipc.IpcWriteOptions(compression=None))
+    with writer:
+        writer.write_table(table.cast(schema))
+        for start in range(chunksize, len(df), chunksize):
+            writer.write_table(pa.Table.from_pandas(
+                df.iloc[start:start + chunksize], schema=schema,
+                preserve_index=False))
+
+
+def write_csv(df, columns, path, append=False, chunksize=CSV_CHUNKSIZE):
+    # writes df[columns] without projecting the whole frame first: only one
+    # row slice at a time is formatted, through one reused file buffer
+    with open(path, 'a' if append else 'w', newline='', buffering=CSV_BUFFER) as fh:
+        for start in range(0, max(len(df), 1), chunksize):
+            df.iloc[start:start + chunksize].to_csv(
+                fh, columns=columns, index=False,
+                header=start == 0 and not append)
+
+
+def write_output(df, columns, csv_file, append=False, columnar=None):
+    write_csv(df, columns, csv_file, append=append)
+    if columnar is not None:
+        write_columnar(df, columns, columnar_path(csv_file, columnar), columnar,
+                       append=append)
+
+
+def write_partitions(df, plan, append=False, columnar=None):
+    # splits the A2 columns into one dataset per EXP_Cond_HR label with a
+    # single stable sort of the rows by condition code, so each condition's
+    # rows are one contiguous run of the order and are gathered once
+    if not append and os.path.isdir(PARTITION_DIR):
+        shutil.rmtree(PARTITION_DIR)
+    os.makedirs(PARTITION_DIR, exist_ok=True)
+    columns = plan['outputs']['filter']
+    positions = df.columns.get_indexer(columns)
+    conditions = df['EXP_Cond_HR'].cat
+    codes = conditions.codes.to_numpy()
+    order = np.argsort(codes, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(
+        np.bincount(codes[codes >= 0], minlength=len(conditions.categories)))])
+    start = np.count_nonzero(codes < 0)
+    for i, label in enumerate(conditions.categories):
+        rows = order[start + bounds[i]:start + bounds[i + 1]]
+        if not len(rows):
+            continue
+        part = df.iloc[rows, positions]
+        path = os.path.join(PARTITION_DIR, label + '.csv')
+        write_csv(part, columns, path, append=os.path.exists(path))
+        if columnar is not None:
+            write_columnar(part, columns, columnar_path(path, columnar), columnar,
+                           append=True)
+
+
+def write_outputs(df, plan, append=False, long=False, cube=False, columnar=None,
+                  partition=False):
+    # A1 holds every recoded column, A2 only the combined variables, the
+    # optional A3 the answered block items in long form and the optional A4
+    # the aggregate cube; with columnar set A1 and A2 are also written as
+    # Parquet or Feather datasets. A1 and A2 are written from the same frame,
+    # on two threads when there is more than one core to overlap them on
+    workers = 2 if (os.cpu_count() or 1) > 1 else 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(write_output, df, plan['outputs'][name], csv_file,
+                        append, columnar)
+            for name, csv_file in [('all', ALL_FILE), ('filter', FILTER_FILE)]]
+        for future in futures:
+            future.result()
+    if long:
+        long_table(df, plan).to_csv(
+            LONG_FILE, index=False, mode='a' if append else 'w', header=not append)
+    if cube:
+        write_cube(build_cube(df, plan), plan, append=append)
+    if partition:
+        write_partitions(df, plan, append=append, columnar=columnar)
+
+
+def output_columns(plan, long=False, cube=False, partition=False):
+    # every column of the processed frame that write_outputs reads for the
+    # requested outputs, in A1 order first
+    columns = list(plan['outputs']['all']) + list(plan['outputs']['filter'])
+    if long:
+        columns += ['ResponseId'] + [
+            column for code, label, block in plan['conditions'] for column in block]
+    if cube:
+        bands = plan['cube']['bands']
+        columns += [bands[dim]['column'] if dim in bands else dim
+                    for dim in plan['cube']['dimensions']]
+        columns += plan['cube']['outcomes'] + plan['cube']['histograms']
+    if partition:
+        columns.append('EXP_Cond_HR')
+    return list(dict.fromkeys(columns))
+
+
+def report_unmapped(unmapped, fail=False):
+    # writes the (column, label, count) rows collected while recoding to
+    # UNMAPPED_FILE; with fail=True any unmapped label stops the run
+    report = (pd.DataFrame(unmapped, columns=['column', 'label', 'count'])
+              .groupby(['column', 'label'], as_index=False, sort=False)['count']
+              .sum())
+    report.to_csv(UNMAPPED_FILE, index=False)
+    if not report.empty:
+        print('\nLabels missing from their value map (recoded as NA):')
+        print(report.to_string(index=False))
+        if fail:
+            raise SystemExit('{} unmapped labels in {} columns, see {}'.format(
+                len(report), report['column'].nunique(), UNMAPPED_FILE))
+    return report
+
+
+def report_multi_block(multi):
+    if multi:
+        print('\nWarning: {} respondents answered more than one condition block '
+              'and were assigned to the last one (see EXP_Cond_Blocks)'.format(multi))
+
+
+def run(path, plan, cache_dir=None, engine='c', fail_on_unmapped=False,
+        long=False, cube=False, columnar=None, partition=False, end=None,
+        cutpoints=None):
+    unmapped = []
+    df, multi = process(
+        ingest(path, plan, cache_dir=cache_dir, engine=engine, end=end),
+        plan, unmapped=unmapped, cutpoints=cutpoints)
+    report_multi_block(multi)
+    report_unmapped(unmapped, fail=fail_on_unmapped)
+    write_outputs(df, plan, long=long, cube=cube, columnar=columnar,
+                  partition=partition)
+    return df
+
+
+def scan_export(path, plan, chunksize=100000):
+    # one streamed pass that parses only the recoded, scale and segment
+    # columns and writes nothing. Returns the unmapped labels of the whole
+    # export and, when a segment uses quantiles, a frame of the segment
+    # columns to take them from
+    raw_names = {new: raw for raw, new in plan['rename'].items()}
+    needed = set(plan['text_sources'])
+    for values, columns in plan['recode']:
+        needed.update(raw_names.get(column, column) for column in columns)
+    needed.update(raw_names.get(column, column)
+                  for column, offset in plan['scales']['columns'])
+    needed.update(raw_names.get(column, column) for column in segment_columns(plan))
+    recoded = dict(plan, usecols=[c for c in plan['usecols'] if c in needed])
+
+    unmapped, frames = [], []
+    with quiet():
+        for chunk in read_export(path, recoded, chunksize=chunksize):
+            chunk = recode_items(clean_text(rename_columns(chunk, plan), plan),
+                                 plan, unmapped=unmapped)
+            if quantile_segments(plan):
+                chunk = score_scales(
+                    combine_conditions(code_conditions(chunk, plan), plan), plan)
+                frames.append(chunk[segment_columns(plan)])
+    frame = pd.concat(frames, ignore_index=True) if frames else None
+    return unmapped, frame
+
+
+def export_cutpoints(frames, plan):
+    # quantile cutpoints of every segment over the concatenated scan frames
+    cutpoints = {}
+    frames = [frame for frame in frames if frame is not None]
+    if frames:
+        with quiet():
+            segment_scales(pd.concat(frames, ignore_index=True), plan, cutpoints)
+    print('Segment cutpoints over the whole data:')
+    report_cutpoints(cutpoints)
+    print()
+    return cutpoints
+
+
+def run_streaming(path, plan, chunksize=100000, fail_on_unmapped=False,
+                  long=False, cube=False, columnar=None, partition=False):
+    # streams the export in fixed-size row chunks so peak memory is bounded
+    # by the chunk size rather than the size of the export. A first pass
+    # over the whole export takes the segment quantiles and, with
+    # fail_on_unmapped, checks every label, so a failed run never leaves the
+    # outputs of the chunks before the bad label behind
+    cutpoints = {}
+    if fail_on_unmapped or quantile_segments(plan):
+        print('Scanning the export...\n')
+        scan_unmapped, frame = scan_export(path, plan, chunksize)
+        if fail_on_unmapped:
+            report_unmapped(scan_unmapped, fail=True)
+        cutpoints = export_cutpoints([frame], plan)
+
+    cond_counts = pd.Series(dtype='int64')
+    rows = 0
+    multi = 0
+    unmapped = []
+    for i, chunk in enumerate(read_export(path, plan, chunksize=chunksize)):
+        chunk, chunk_multi = process(chunk, plan, verbose=False, unmapped=unmapped,
+                                     cutpoints=cutpoints)
+        multi += chunk_multi
+        write_outputs(chunk, plan, append=i > 0, long=long, cube=cube,
+                      columnar=columnar, partition=partition)
+        cond_counts = cond_counts.add(chunk.EXP_Cond_HR.value_counts(), fill_value=0)
+        rows += len(chunk)
+        print('Processed chunk {} ({} rows total)'.format(i + 1, rows))
+
+    print('\nHumanReadable')
+    print(cond_counts.astype('int64').sort_values(ascending=False))
+    report_multi_block(multi)
+    report_unmapped(unmapped)
+
+
+def find_exports(pattern):
+    # a directory means every CSV in it; anything else is used as a glob.
+    # Our own outputs are skipped so a batch can run inside its input folder
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.csv')
+    outputs = {ALL_FILE, FILTER_FILE, LONG_FILE, CUBE_FILE, ERRORS_FILE,
+               UNMAPPED_FILE}
+    return sorted(
+        path for path in glob.glob(pattern)
+        if os.path.basename(path) not in outputs)
+
+
+def scan_segments(path, plan):
+    # batch worker for the first pass: the segment frame of one export, or
+    # None when it cannot be read (the error is reported by process_export)
+    try:
+        return scan_export(path, plan)[1]
+    except Exception:
+        return None
+
+
+def process_export(path, plan, cache_dir=None, engine='c', fail_on_unmapped=False,
+                   cutpoints=None, columns=None):
+    # batch worker: returns (path, frame of the output columns, unmapped,
+    # multi-block count, None) or (path, None, None, None, error)
+    try:
+        unmapped = []
+        with quiet():
+            df, multi = process(ingest(path, plan, cache_dir=cache_dir, engine=engine),
+                                plan, verbose=False, unmapped=unmapped,
+                                cutpoints=cutpoints)
+        if fail_on_unmapped and unmapped:
+            raise ValueError('unmapped labels: {}'.format(
+                ', '.join('{}={!r}'.format(c, l) for c, l, n in unmapped)))
+        return path, df.loc[:, columns], unmapped, multi, None
+    except Exception:
+        return path, None, None, None, traceback.format_exc()
+
+
+def run_batch(pattern, plan, workers=None, cache_dir=None, engine='c',
+              fail_on_unmapped=False, long=False, cube=False, columnar=None,
+              partition=False):
+    # preprocesses every matching export in a process pool and writes one
+    # concatenated A1/A2 pair, in file name order, plus an error report.
+    # Exports are submitted at most workers ahead of the one being written
+    # and each result is dropped once written, so finished frames waiting on
+    # an earlier file never number more than the workers. Segment quantiles
+    # are taken over all exports in a first pass
+    paths = find_exports(pattern)
+    print('Processing {} exports...\n'.format(len(paths)))
+    workers = workers or os.cpu_count() or 1
+    columns = output_columns(plan, long=long, cube=cube, partition=partition)
+
+    errors = []
+    unmapped = []
+    multi = 0
+    written = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        cutpoints = {}
+        if quantile_segments(plan):
+            cutpoints = export_cutpoints(
+                pool.map(scan_segments, paths, [plan] * len(paths)), plan)
+        futures = {}
+        for i in range(len(paths)):
+            for j in range(i, min(i + workers, len(paths))):
+                if j not in futures:
+                    futures[j] = pool.submit(process_export, paths[j], plan,
+                                             cache_dir, engine, fail_on_unmapped,
+                                             cutpoints, columns)
+            path, df, file_unmapped, file_multi, error = futures.pop(i).result()
+            if error is not None:
+                errors.append({
+                    'file': path,
+                    'error': error.strip().splitlines()[-1],
+                    'traceback': error})
+                print('FAILED {}: {}'.format(path, errors[-1]['error']))
+                continue
+            write_outputs(df, plan, append=written > 0, long=long, cube=cube,
+                          columnar=columnar, partition=partition)
+            unmapped.extend(file_unmapped)
+            multi += file_multi
+            written += 1
+            print('Processed {} ({} rows)'.format(path, len(df)))
+            del df
+
+    pd.DataFrame(errors, columns=['file', 'error', 'traceback']).to_csv(
+        ERRORS_FILE, index=False)
+    print('\n{} of {} exports processed, {} failed (see {})'.format(
+        written, len(paths), len(errors), ERRORS_FILE))
+    report_multi_block(multi)
+    report_unmapped(unmapped)
+    return errors
+
+
+def export_checksum(path, offset, size=1 << 16):
+    # fingerprint of the header and the bytes just before offset; if it still
+    # matches, the export only grew at the end since the last run
+    with open(path, 'rb') as fh:
+        header = fh.readline()
+        fh.seek(max(offset - size, 0))
+        tail = fh.read(min(size, offset))
+    return hashlib.sha256(header + tail).hexdigest()
+
+
+def save_state(path, response_ids, offset, cutpoints, append=True):
+    # processed ResponseIds are appended to IDS_FILE; STATE_FILE records how
+    # far into the export we have read and the segment cutpoints in use
+    with open(IDS_FILE, 'a' if append else 'w') as fh:
+        for response_id in response_ids:
+            fh.write('{}\n'.format(response_id))
+    with open(STATE_FILE, 'w') as fh:
+        json.dump({
+            'export': os.path.abspath(path),
+            'offset': offset,
+            'checksum': export_checksum(path, offset),
+            'cutpoints': cutpoints}, fh, indent=2)
+
+
+def read_new_rows(path, plan, state, end):
+    # parses only the rows between the recorded offset and end, or returns
+    # None when the export was rewritten rather than appended to
+    offset = state['offset']
+    if (os.path.abspath(path) != state['export']
+            or end < offset
+            or export_checksum(path, offset) != state['checksum']):
+        return None
+
+    columns = pd.read_csv(path, nrows=0).columns
+    if end == offset:
+        return pd.DataFrame(columns=plan['usecols'])
+    with export_slice(path, offset, end) as fh:
+        df = pd.read_csv(fh, header=None, names=columns,
+                         usecols=plan['usecols'], dtype=likert_dtypes(plan))
+    return fix_categories(df, plan)
+
+
+def run_incremental(path, plan, engine='c', fail_on_unmapped=False, long=False,
+                    cube=False, columnar=None, partition=False):
+    # processes only responses whose ResponseId is not in IDS_FILE and
+    # appends them to the A1/A2 outputs; the first run is a full run. The
+    # export is read up to its last complete row at the start of the run and
+    # that offset is saved, so rows appended while the run is in progress are
+    # picked up by the next run. Appended rows are segmented with the
+    # cutpoints of the first run, so they match the rows already written
+    end = complete_size(path)
+    outputs = ([ALL_FILE, FILTER_FILE] + ([LONG_FILE] if long else [])
+               + ([CUBE_FILE] if cube else []))
+    if columnar is not None:
+        outputs += [columnar_path(f, columnar) for f in [ALL_FILE, FILTER_FILE]]
+    if partition:
+        outputs.append(PARTITION_DIR)
+    if not all(os.path.exists(f) for f in [STATE_FILE, IDS_FILE] + outputs):
+        print('No incremental state found, processing the full export\n')
+        cutpoints = {}
+        df = run(path, plan, engine=engine, fail_on_unmapped=fail_on_unmapped,
+                 long=long, cube=cube, columnar=columnar, partition=partition,
+                 end=end, cutpoints=cutpoints)
+        save_state(path, df.ResponseId, end, cutpoints, append=False)
+        return df
+
+    with open(STATE_FILE) as fh:
+        state = json.load(fh)
+    cutpoints = state.get('cutpoints', {})
+    if cutpoints:
+        print('Segment cutpoints saved by the first run:')
+        report_cutpoints(cutpoints)
+        print()
+    elif quantile_segments(plan):
+        print('Warning: no saved segment cutpoints, taking quantiles over the '
+              'new responses\n')
+    with open(IDS_FILE) as fh:
+        seen = set(line.rstrip('\n') for line in fh)
+
+    df = read_new_rows(path, plan, state, end)
+    if df is None:
+        print('Export was rewritten, filtering it by ResponseId\n')
+        df = read_export(path, plan, engine=engine, end=end)
+    df = df.loc[~df.ResponseId.isin(seen)].reset_index(drop=True)
+
+    if df.empty:
+        print('No new responses')
+    else:
+        unmapped = []
+        df, multi = process(df, plan, unmapped=unmapped, cutpoints=cutpoints)
+        report_multi_block(multi)
+        report_unmapped(unmapped, fail=fail_on_unmapped)
+        write_outputs(df, plan, append=True, long=long, cube=cube,
+                      columnar=columnar, partition=partition)
+        print('\nAppended {} new responses'.format(len(df)))
+    save_state(path, df.ResponseId, end, cutpoints)
+    return df
 
 
 # ## Combining Like Variables 
@@ -1910,3 +1275,102 @@ df_filter.to_csv('A2-SDO_Campaigns_filter.csv', index=False)
 #     * **15** - I would probably vote for Robert Gardner.
 #     * **16** - If asked, I would contribute time or money to Robert Gardner’s campaign.
 #     * **17** - Robert Gardner’s advertisement is effective at persuading undecided voters to elect him.
+
+
+# In[11]:
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Preprocess the SDO campaign messages Qualtrics export.')
+    parser.add_argument(
+        'export', nargs='?', default=EXPORT_FILE,
+        help='human readable Qualtrics export (default: %(default)s)')
+    parser.add_argument(
+        '--codebook', default=CODEBOOK_FILE,
+        help='codebook describing the export (default: %(default)s)')
+    parser.add_argument(
+        '--chunksize', type=int, default=None,
+        help='stream the export in chunks of this many rows, appending '
+             'each processed chunk to the A1/A2 outputs')
+    parser.add_argument(
+        '--cache', action='store_true',
+        help='cache the ingested export as Feather, keyed by its content '
+             'hash, and memory-map the cache on later runs')
+    parser.add_argument(
+        '--cache-dir', default=CACHE_DIR,
+        help='directory for the ingest cache (default: %(default)s)')
+    parser.add_argument(
+        '--engine', choices=['c', 'pyarrow'], default='c',
+        help="CSV parser for whole-file runs; 'pyarrow' uses Arrow's "
+             "multi-threaded reader (default: %(default)s)")
+    parser.add_argument(
+        '--batch', metavar='GLOB_OR_DIR',
+        help='preprocess every export matching a glob (or every CSV in a '
+             'directory) in a process pool and concatenate the outputs')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='worker processes for --batch (default: one per core)')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='process only responses not seen by an earlier --incremental '
+             'run and append them to the A1/A2 outputs')
+    parser.add_argument(
+        '--fail-on-unmapped', action='store_true',
+        help='exit with an error, before writing outputs, when any label is '
+             'missing from its value map (see {})'.format(UNMAPPED_FILE))
+    parser.add_argument(
+        '--long', action='store_true',
+        help='also write the answered condition block items as a long table, '
+             'one row per respondent and item ({})'.format(LONG_FILE))
+    parser.add_argument(
+        '--cube', action='store_true',
+        help='also write counts, sums, sums of squares and histograms of the '
+             'outcomes by condition and demographics ({})'.format(CUBE_FILE))
+    parser.add_argument(
+        '--columnar', choices=sorted(COLUMNAR_FORMATS),
+        help='also write A1/A2 as Parquet (zstd-compressed) or Feather '
+             '(uncompressed, memory-mappable) datasets that keep the column '
+             'dtypes')
+    parser.add_argument(
+        '--partition', action='store_true',
+        help='also write the A2 columns split into one file per test '
+             'condition under {}/'.format(PARTITION_DIR))
+    args = parser.parse_args(argv)
+
+    if args.incremental and (args.batch or args.chunksize or args.cache):
+        parser.error('--incremental cannot be combined with --batch, '
+                     '--chunksize or --cache')
+    if args.batch and args.chunksize:
+        parser.error('--batch cannot be combined with --chunksize')
+    if args.chunksize and args.cache:
+        parser.error('--cache cannot be combined with --chunksize')
+    if args.chunksize and args.engine != 'c':
+        parser.error('--chunksize is only supported by the c engine')
+
+    plan = compile_codebook(load_codebook(args.codebook))
+    if args.batch:
+        run_batch(args.batch, plan, workers=args.workers,
+                  cache_dir=args.cache_dir if args.cache else None,
+                  engine=args.engine, fail_on_unmapped=args.fail_on_unmapped,
+                  long=args.long, cube=args.cube, columnar=args.columnar,
+                  partition=args.partition)
+    elif args.incremental:
+        run_incremental(args.export, plan, engine=args.engine,
+                        fail_on_unmapped=args.fail_on_unmapped, long=args.long,
+                        cube=args.cube, columnar=args.columnar,
+                        partition=args.partition)
+    elif args.chunksize:
+        run_streaming(args.export, plan, chunksize=args.chunksize,
+                      fail_on_unmapped=args.fail_on_unmapped, long=args.long,
+                      cube=args.cube, columnar=args.columnar,
+                      partition=args.partition)
+    else:
+        run(args.export, plan, cache_dir=args.cache_dir if args.cache else None,
+            engine=args.engine, fail_on_unmapped=args.fail_on_unmapped,
+            long=args.long, cube=args.cube, columnar=args.columnar,
+            partition=args.partition)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,716 @@
+# coding: utf-8
+
+# # Data Analysis
+#
+# **Script Goals**
+# * Scale reliability (Cronbach's alpha, omega) overall and per test condition
+# * Bootstrap confidence intervals
+# * Bootstrap of outcome means and contrasts per test condition
+# * Permutation tests of the target and tone contrasts
+# * Two-way (target x tone) ANOVA of every outcome, overall and by subgroup
+# * SDO x condition moderation regressions of every outcome
+#
+# Reads the A2 filter output of S1-Preprocessing_PolSDO.py and the scale
+# definitions in SDO_Campaigns_Codebook.json.
+
+# In[1]:
+
+
+# importing libraries
+import argparse
+import concurrent.futures
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+# In[2]:
+
+
+FILTER_FILE = 'A2-SDO_Campaigns_filter.csv'
+CODEBOOK_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'SDO_Campaigns_Codebook.json')
+RELIABILITY_FILE = 'B1-SDO_Campaigns_Reliability.csv'
+BOOTSTRAP_FILE = 'B2-SDO_Campaigns_Bootstrap.csv'
+PERMUTATION_FILE = 'B3-SDO_Campaigns_Permutation.csv'
+ANOVA_FILE = 'B4-SDO_Campaigns_ANOVA.csv'
+REGRESSION_FILE = 'B5-SDO_Campaigns_Regression.csv'
+ANALYSES = ['reliability', 'bootstrap', 'permutation', 'anova', 'regression']
+
+# resampling work is cut into tasks of this many replicates, each with its
+# own seed spawned from the run seed, so results do not depend on the number
+# of workers
+TASK_SIZE = 1000
+
+# resample weights are drawn in batches of at most this many (replicate x
+# row) cells, about 32 MB as float64, so memory does not grow with the sample
+BATCH_CELLS = 1 << 22
+
+
+def load_codebook(path=CODEBOOK_FILE):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def read_filter(path=FILTER_FILE):
+    # the A2 CSV, or its Parquet / Feather dataset written with --columnar
+    if path.rstrip(os.sep).endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.rstrip(os.sep).endswith('.feather'):
+        from pyarrow import dataset
+        return dataset.dataset(path, format='feather').to_table().to_pandas()
+    return pd.read_csv(path)
+
+
+def scale_items(df, scale):
+    # (rows x items) float64 matrix of a codebook scale, with the scale's
+    # reverse items scored as (low + high) - value
+    items = df[scale['items']].to_numpy(dtype='float64', na_value=np.nan)
+    reverse = [column in scale.get('reverse', []) for column in scale['items']]
+    if any(reverse):
+        items[:, reverse] = sum(scale['range']) - items[:, reverse]
+    return items
+
+
+def outcomes(codebook):
+    # the unified message / candidate items followed by the composite scales
+    return ([item['name'] for kind in ['message', 'candidate']
+             for item in codebook['items'][kind]]
+            + [scale['name'] for scale in codebook['scales']])
+
+
+def contrasts(codebook):
+    # (names, contrasts x conditions matrix) of the pairwise differences
+    # between the levels of each design factor (target, tone), each level
+    # being the unweighted mean of its condition means
+    names, rows = [], []
+    for factor in ['target', 'tone']:
+        cells = np.array([cond[factor] for cond in codebook['conditions']])
+        levels = list(dict.fromkeys(cells))
+        for i, first in enumerate(levels):
+            for second in levels[i + 1:]:
+                names.append('{} - {}'.format(first, second))
+                rows.append((cells == first) / (cells == first).sum()
+                            - (cells == second) / (cells == second).sum())
+    return names, np.array(rows)
+
+
+def condition_data(df, codebook, columns):
+    # per test condition: the outcome matrix with missing answers as 0 and
+    # the matching answered mask as floats, so sums and counts are products
+    data = []
+    for cond in codebook['conditions']:
+        values = df.loc[df['EXP_Cond'] == cond['code'], columns].to_numpy(
+            dtype='float64', na_value=np.nan)
+        answered = ~np.isnan(values)
+        data.append((np.where(answered, values, 0), answered.astype('float64')))
+    return data
+
+
+def run_tasks(function, data, replicates, seed=None, workers=None):
+    # splits replicates into TASK_SIZE tasks with seeds spawned from seed and
+    # runs function(data, size, seed) for each, in a process pool unless
+    # workers is 1; the results are concatenated in task order
+    sizes = [min(TASK_SIZE, replicates - start)
+             for start in range(0, replicates, TASK_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers == 1:
+        results = [function(data, size, task_seed)
+                   for size, task_seed in zip(sizes, seeds)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(
+                function, [data] * len(sizes), sizes, seeds))
+    return np.concatenate(results)
+
+
+def batch_size(n, replicates):
+    # replicates per batch of (replicates x n) resample weights
+    return max(1, min(replicates, BATCH_CELLS // max(n, 1)))
+
+
+def groups(df, codebook):
+    # (label, row mask) for the whole sample and for every test condition
+    yield 'All', np.ones(len(df), dtype=bool)
+    for cond in codebook['conditions']:
+        yield cond['label'], (df['EXP_Cond'] == cond['code']).to_numpy()
+
+
+# **Reliability**
+#
+# * Cronbach's alpha = k / (k - 1) * (1 - sum of item variances / variance of
+#   the sum), both read off the item covariance matrix
+# * omega = (sum of loadings)^2 / ((sum of loadings)^2 + sum of unique
+#   variances), with the loadings of a one-factor model approximated by the
+#   first principal component of the covariance matrix
+#
+# Both are computed on the respondents who answered every item of the scale.
+
+# In[3]:
+
+
+def alpha(cov):
+    # works on one (k x k) matrix or a stack of them
+    k = cov.shape[-1]
+    total = cov.sum(axis=(-2, -1))
+    return k / (k - 1) * (1 - np.trace(cov, axis1=-2, axis2=-1) / total)
+
+
+def omega(cov):
+    values, vectors = np.linalg.eigh(cov)
+    loadings = vectors[..., -1] * np.sqrt(np.maximum(values[..., -1:], 0))
+    common = loadings.sum(axis=-1) ** 2
+    unique = (np.diagonal(cov, axis1=-2, axis2=-1) - loadings ** 2).sum(axis=-1)
+    return common / (common + unique)
+
+
+def weighted_cov(weights, items, products):
+    # covariance of items under every row of resample counts at once:
+    # weights is (replicates x rows) and each row sums to the number of rows,
+    # so one product gives the item sums and one, with the row-wise outer
+    # products of the items, the cross products
+    n, k = items.shape
+    sums = weights @ items
+    products = (weights @ products).reshape(-1, k, k)
+    return (products - sums[:, :, None] * sums[:, None, :] / n) / (n - 1)
+
+
+def bootstrap_reliability(items, replicates, rng, batch=None):
+    # (replicates x 2) alpha and omega of resamples of the complete rows; a
+    # resample is drawn as multinomial counts over the rows rather than as
+    # an index array, in batches sized from the rows so memory stays bounded
+    n = len(items)
+    batch = batch_size(n, replicates) if batch is None else batch
+    products = outer_rows(items)
+    out = np.empty((replicates, 2))
+    for start in range(0, replicates, batch):
+        size = min(batch, replicates - start)
+        weights = rng.multinomial(n, np.full(n, 1 / n), size=size).astype('float64')
+        cov = weighted_cov(weights, items, products)
+        out[start:start + size, 0] = alpha(cov)
+        out[start:start + size, 1] = omega(cov)
+    return out
+
+
+def reliability(df, codebook, replicates=2000, seed=None, level=0.95):
+    # one row per scale and group (All plus every test condition) with alpha,
+    # omega and their percentile bootstrap intervals
+    rng = np.random.default_rng(seed)
+    tails = [(1 - level) / 2 * 100, (1 + level) / 2 * 100]
+    rows = []
+    for scale in codebook['scales']:
+        items = scale_items(df, scale)
+        complete = ~np.isnan(items).any(axis=1)
+        for label, mask in groups(df, codebook):
+            data = items[mask & complete]
+            row = {'scale': scale['name'], 'group': label,
+                   'n': len(data), 'k': items.shape[1]}
+            if len(data) > items.shape[1]:
+                cov = np.cov(data, rowvar=False)
+                row.update(alpha=alpha(cov), omega=omega(cov))
+                if replicates:
+                    boot = bootstrap_reliability(data, replicates, rng)
+                    (row['alpha_lo'], row['alpha_hi']), (row['omega_lo'], row['omega_hi']) = (
+                        np.nanpercentile(boot, tails, axis=0).T)
+            rows.append(row)
+    return pd.DataFrame(rows, columns=[
+        'scale', 'group', 'n', 'k', 'alpha', 'alpha_lo', 'alpha_hi',
+        'omega', 'omega_lo', 'omega_hi'])
+
+
+# **Condition Means**
+#
+# Each replicate resamples respondents with replacement within every test
+# condition (a stratified bootstrap), drawn as multinomial counts over the
+# condition's rows. The means of every outcome in a condition are then two
+# products of the (replicates x rows) counts with the outcome matrix.
+
+# In[4]:
+
+
+def bootstrap_task(data, replicates, seed):
+    # (replicates x conditions x outcomes) resampled means, NaN for a
+    # condition without rows
+    rng = np.random.default_rng(seed)
+    out = np.full((replicates, len(data), data[0][0].shape[1]), np.nan)
+    for c, (values, answered) in enumerate(data):
+        n = len(values)
+        if not n:
+            continue
+        batch = batch_size(n, replicates)
+        for start in range(0, replicates, batch):
+            size = min(batch, replicates - start)
+            weights = rng.multinomial(n, np.full(n, 1 / n), size=size).astype('float64')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out[start:start + size, c] = (weights @ values) / (weights @ answered)
+    return out
+
+
+def bootstrap_means(df, codebook, columns=None, replicates=10000, seed=None,
+                    workers=None, level=0.95):
+    # one row per outcome and statistic (each condition mean and each factor
+    # contrast) with the estimate, bootstrap SE and percentile interval
+    columns = outcomes(codebook) if columns is None else columns
+    data = condition_data(df, codebook, columns)
+    names, matrix = contrasts(codebook)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.array([values.sum(axis=0) / answered.sum(axis=0)
+                          for values, answered in data])
+    counts = np.array([answered.sum(axis=0) for values, answered in data])
+
+    boot = run_tasks(bootstrap_task, data, replicates, seed=seed, workers=workers)
+    boot = np.concatenate([boot, np.einsum('mc,rcp->rmp', matrix, boot)], axis=1)
+    estimates = np.concatenate([means, matrix @ means])
+    n = np.concatenate([counts, (matrix != 0) @ counts])
+    # statistics of an empty condition are all NaN and stay NaN, quietly
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        se = np.nanstd(boot, axis=0, ddof=1)
+        low, high = np.nanpercentile(
+            boot, [(1 - level) / 2 * 100, (1 + level) / 2 * 100], axis=0)
+
+    labels = [cond['label'] for cond in codebook['conditions']] + names
+    kinds = ['mean'] * len(codebook['conditions']) + ['contrast'] * len(names)
+    return pd.DataFrame({
+        'outcome': np.repeat([columns], len(labels), axis=0).T.ravel(),
+        'statistic': labels * len(columns),
+        'kind': kinds * len(columns),
+        'n': n.T.ravel().astype('int64'),
+        'estimate': estimates.T.ravel(),
+        'se': se.T.ravel(),
+        'lo': low.T.ravel(),
+        'hi': high.T.ravel(),
+    })
+
+
+# **Permutation Tests**
+#
+# Under the null of no condition effect the EXP_Cond labels of the tested
+# respondents are exchangeable. Each batch of permutations is a (permutations
+# x rows) matrix of shuffled labels; the condition means of every outcome
+# are products of its membership masks with the outcome matrix, and every
+# contrast of every outcome follows from one more product. p-values are
+# two-sided: (1 + permutations at least as extreme) / (1 + permutations),
+# counting only permutations whose contrast is defined; a contrast that is
+# not defined in the data (a condition without answers) has no p-value.
+
+# In[5]:
+
+
+def permutation_task(data, permutations, seed, batch=None):
+    # (1 x 2 x contrasts x outcomes) counts of the permuted contrasts at least
+    # as far from 0 as the observed ones, and of the defined (non-NaN) ones
+    values, answered, labels, matrix, observed = data
+    rng = np.random.default_rng(seed)
+    n_conditions = matrix.shape[1]
+    batch = batch_size(len(labels), permutations) if batch is None else batch
+    exceed = np.zeros(observed.shape)
+    defined = np.zeros(observed.shape)
+    for start in range(0, permutations, batch):
+        size = min(batch, permutations - start)
+        shuffled = rng.permuted(np.tile(labels, (size, 1)), axis=1)
+        means = np.empty((size, n_conditions, values.shape[1]))
+        for c in range(n_conditions):
+            member = (shuffled == c).astype('float64')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means[:, c] = (member @ values) / (member @ answered)
+        stats = np.einsum('mc,bcp->bmp', matrix, means)
+        exceed += (np.abs(stats) >= np.abs(observed) * (1 - 1e-9)).sum(axis=0)
+        defined += (~np.isnan(stats)).sum(axis=0)
+    return np.stack([exceed, defined])[None]
+
+
+def permutation_tests(df, codebook, columns=None, permutations=10000, seed=None,
+                      workers=None):
+    # one row per outcome and factor contrast with the observed contrast and
+    # its permutation p-value
+    columns = outcomes(codebook) if columns is None else columns
+    names, matrix = contrasts(codebook)
+    codes = [cond['code'] for cond in codebook['conditions']]
+    tested = df['EXP_Cond'].isin(codes).to_numpy()
+    labels = pd.Categorical(df.loc[tested, 'EXP_Cond'], categories=codes).codes
+    values = df.loc[tested, columns].to_numpy(dtype='float64', na_value=np.nan)
+    answered = ~np.isnan(values)
+    values = np.where(answered, values, 0)
+    answered = answered.astype('float64')
+
+    member = (labels[:, None] == np.arange(len(codes))).astype('float64').T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed = matrix @ ((member @ values) / (member @ answered))
+
+    data = (values, answered, labels, matrix, observed)
+    exceed, defined = run_tasks(permutation_task, data, permutations, seed=seed,
+                                workers=workers).sum(axis=0)
+    p_value = np.where(np.isnan(observed), np.nan, (1 + exceed) / (1 + defined))
+    return pd.DataFrame({
+        'outcome': np.repeat([columns], len(names), axis=0).T.ravel(),
+        'contrast': names * len(columns),
+        'estimate': observed.T.ravel(),
+        'p_value': p_value.T.ravel(),
+        'permutations': defined.T.ravel().astype('int64'),
+    })
+
+
+# **Factorial ANOVA**
+#
+# EXP_Cond is a 2 (target: HE / HA) x 3 (tone: CivilPositive / CivilNegative
+# / Uncivil) design; each condition's factor levels come from the codebook.
+# With unequal cell sizes the Type III sum of squares of an effect is that of
+# its hypothesis L mu = 0 on the cell means mu:
+#
+#     SS = (L ybar)' (L N^-1 L')^-1 (L ybar)
+#
+# with N the diagonal of cell sizes, and the error SS is the within-cell SS.
+# Both only need each cell's count, sum and sum of squares, so every outcome
+# and every subgroup is tested from one set of grouped sums without fitting a
+# model. p-values need scipy and are left empty without it.
+
+# In[6]:
+
+
+def factor_hypotheses(codebook):
+    # [(effect, hypothesis x conditions matrix)] for the two main effects
+    # (each level's unweighted marginal mean against the last level's) and
+    # their interaction
+    conditions = codebook['conditions']
+    cells = {(cond['target'], cond['tone']): c for c, cond in enumerate(conditions)}
+    hypotheses = []
+    levels = {}
+    for factor in ['target', 'tone']:
+        column = np.array([cond[factor] for cond in conditions])
+        levels[factor] = list(dict.fromkeys(column))
+        marginal = np.array([(column == level) / (column == level).sum()
+                             for level in levels[factor]])
+        hypotheses.append((factor, marginal[:-1] - marginal[-1]))
+
+    rows = []
+    last_target, last_tone = levels['target'][-1], levels['tone'][-1]
+    for target in levels['target'][:-1]:
+        for tone in levels['tone'][:-1]:
+            row = np.zeros(len(conditions))
+            row[cells[target, tone]] += 1
+            row[cells[target, last_tone]] -= 1
+            row[cells[last_target, tone]] -= 1
+            row[cells[last_target, last_tone]] += 1
+            rows.append(row)
+    hypotheses.append(('target:tone', np.array(rows)))
+    return hypotheses
+
+
+def cell_statistics(values, cells, groups, n_groups, n_cells):
+    # (groups x conditions x outcomes) answered counts, sums and sums of
+    # squares, one bincount per outcome over the combined group-cell index
+    index = groups * n_cells + cells
+    shape = (n_groups, n_cells)
+    out = np.zeros((3, n_groups * n_cells, values.shape[1]))
+    for k in range(values.shape[1]):
+        answered = ~np.isnan(values[:, k])
+        where, column = index[answered], values[answered, k]
+        out[0, :, k] = np.bincount(where, minlength=out.shape[1])
+        out[1, :, k] = np.bincount(where, weights=column, minlength=out.shape[1])
+        out[2, :, k] = np.bincount(where, weights=column ** 2, minlength=out.shape[1])
+    return out.reshape((3,) + shape + (values.shape[1],))
+
+
+def anova(df, codebook, columns=None, by=None):
+    # one row per subgroup, outcome and effect (plus the residual) with its
+    # df, SS, mean square, F, p-value and partial eta squared
+    try:
+        from scipy import stats
+    except ImportError:
+        stats = None
+
+    columns = outcomes(codebook) if columns is None else columns
+    codes = [cond['code'] for cond in codebook['conditions']]
+    tested = df['EXP_Cond'].isin(codes).to_numpy()
+    if by is None:
+        groups, names = np.zeros(tested.sum(), dtype='int64'), ['All']
+    else:
+        groups, names = pd.factorize(df.loc[tested, by], sort=True)
+        names = list(names)
+    keep = groups >= 0
+    cells = pd.Categorical(df.loc[tested, 'EXP_Cond'], categories=codes).codes
+    values = df.loc[tested, columns].to_numpy(dtype='float64', na_value=np.nan)
+    n, sums, squares = cell_statistics(
+        values[keep], cells[keep], groups[keep], len(names), len(codes))
+
+    # a subgroup missing a cell cannot be tested; its matrices are replaced
+    # by the identity so the batched solve goes through, and masked after
+    complete = (n > 0).all(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / n
+        inverse = np.where(n > 0, 1 / n, 0)
+    error_ss = np.where(n > 0, squares - sums * means, 0).sum(axis=1)
+    error_df = (n.sum(axis=1) - (n > 0).sum(axis=1)).astype('int64')
+
+    effects = []
+    for effect, matrix in factor_hypotheses(codebook):
+        estimate = np.einsum('rc,gcp->gpr', matrix, np.nan_to_num(means))
+        middle = np.einsum('rc,gcp,sc->gprs', matrix, inverse, matrix)
+        middle[~complete] = np.eye(len(matrix))
+        ss = np.einsum('gpr,gpr->gp', estimate,
+                       np.linalg.solve(middle, estimate[..., None])[..., 0])
+        effects.append((effect, len(matrix), np.where(complete, ss, np.nan)))
+
+    rows = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        error_ms = error_ss / error_df
+        for effect, effect_df, ss in effects:
+            f = ss / effect_df / error_ms
+            p = stats.f.sf(f, effect_df, error_df) if stats is not None else np.nan
+            rows.append(pd.DataFrame({
+                'effect': effect, 'df': effect_df, 'ss': ss.ravel(),
+                'ms': (ss / effect_df).ravel(), 'f': f.ravel(),
+                'p_value': np.broadcast_to(p, ss.shape).ravel(),
+                'partial_eta2': (ss / (ss + error_ss)).ravel()}))
+        rows.append(pd.DataFrame({
+            'effect': 'Residual', 'df': error_df.ravel(), 'ss': error_ss.ravel(),
+            'ms': error_ms.ravel()}))
+    for table in rows:
+        table.insert(0, 'outcome', np.tile(columns, len(names)))
+        table.insert(0, 'group', np.repeat(names, len(columns)))
+        table.insert(0, 'by', 'All' if by is None else by)
+
+    # interleave the per-effect tables: effects of one outcome together,
+    # outcomes in codebook order within each subgroup
+    table = pd.concat(rows, ignore_index=True)
+    order = np.arange(len(table)).reshape(len(rows), -1).T.ravel()
+    return table.iloc[order].reset_index(drop=True)
+
+
+# **Moderation Regressions**
+#
+# outcome ~ SDO + condition dummies + SDO x condition dummies, with the first
+# condition as the reference and SDO centred on its sample mean so that the
+# condition terms are effects at average SDO. The design matrix is built once;
+# each outcome only differs in which rows answered it, so the normal
+# equations of all outcomes come from one product of the answered mask with
+# the row-wise outer products of the design. Standard errors are
+# heteroskedasticity-robust (HC0, HC1 or HC3). The bootstrap refits every
+# outcome on resampled rows the same way, a batch of replicates at a time.
+# Terms that the answered rows cannot identify (e.g. the condition terms on a
+# single-condition partition) are left empty rather than given pinv's
+# arbitrary minimum-norm values.
+
+# In[7]:
+
+
+def design_matrix(df, codebook, moderator='sdo_mean', center=True):
+    # (rows used, design matrix, term names) over tested respondents with a
+    # moderator score
+    codes = [cond['code'] for cond in codebook['conditions']]
+    labels = [cond['label'] for cond in codebook['conditions']]
+    rows = (df['EXP_Cond'].isin(codes) & df[moderator].notna()).to_numpy()
+    cells = pd.Categorical(df.loc[rows, 'EXP_Cond'], categories=codes).codes
+    x = df.loc[rows, moderator].to_numpy(dtype='float64')
+    if center:
+        x = x - x.mean()
+    dummies = (cells[:, None] == np.arange(1, len(codes))).astype('float64')
+    design = np.column_stack([np.ones(len(x)), x, dummies, x[:, None] * dummies])
+    terms = (['Intercept', moderator]
+             + ['C[{}]'.format(label) for label in labels[1:]]
+             + ['{}:C[{}]'.format(moderator, label) for label in labels[1:]])
+    return rows, design, terms
+
+
+def outer_rows(design):
+    # (rows x k*k) row-wise outer products, so X' diag(w) X = w @ outer_rows
+    n, k = design.shape
+    return (design[:, :, None] * design[:, None, :]).reshape(n, k * k)
+
+
+def normal_inverse(xtx):
+    # (pinv of every X'X, estimable terms): a term is estimable when its unit
+    # vector lies in the row space of X'X, i.e. the diagonal of
+    # pinv(X'X) X'X is 1
+    inverse = np.linalg.pinv(xtx, rcond=1e-10, hermitian=True)
+    projection = np.diagonal(inverse @ xtx, axis1=-2, axis2=-1)
+    return inverse, np.isclose(projection, 1, rtol=0, atol=1e-6)
+
+
+def fit_ols(design, values, hc='HC1'):
+    # (coefficients, robust SEs, answered counts) of every outcome column,
+    # coefficients and SEs being (outcomes x terms)
+    n, k = design.shape
+    answered = ~np.isnan(values)
+    mask = answered.astype('float64')
+    values = np.where(answered, values, 0)
+    products = outer_rows(design)
+    inverse, estimable = normal_inverse((mask.T @ products).reshape(-1, k, k))
+    coef = np.einsum('pij,nj,np->pi', inverse, design, values)
+    residuals = (values - design @ coef.T) * mask
+    counts = mask.sum(axis=0)
+
+    if hc == 'HC3':
+        leverage = np.einsum('ni,pij,nj->np', design, inverse, design)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(answered, 1 / (1 - leverage) ** 2, 0)
+    elif hc == 'HC1':
+        scale = np.broadcast_to(counts / (counts - k), (n, len(counts)))
+    else:
+        scale = 1
+    meat = ((residuals ** 2 * scale).T @ products).reshape(-1, k, k)
+    cov = inverse @ meat @ inverse
+    se = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+    coef, se = np.where(estimable, coef, np.nan), np.where(estimable, se, np.nan)
+    return coef, se, counts
+
+
+def regression_task(data, replicates, seed, batch=None):
+    # (replicates x outcomes x terms) coefficients refitted on resamples of
+    # the rows, drawn as multinomial counts in batches sized from the rows;
+    # the outer products of the design are built once per task
+    design, values, mask = data
+    rng = np.random.default_rng(seed)
+    n, k = design.shape
+    batch = batch_size(n, replicates) if batch is None else batch
+    products = outer_rows(design)
+    out = np.empty((replicates, values.shape[1], k))
+    for start in range(0, replicates, batch):
+        size = min(batch, replicates - start)
+        weights = rng.multinomial(n, np.full(n, 1 / n), size=size).astype('float64')
+        for p in range(values.shape[1]):
+            weighted = weights * mask[:, p]
+            inverse, estimable = normal_inverse((weighted @ products).reshape(-1, k, k))
+            coef = np.einsum('rij,rj->ri', inverse, (weighted * values[:, p]) @ design)
+            out[start:start + size, p] = np.where(estimable, coef, np.nan)
+    return out
+
+
+def regression(df, codebook, columns=None, moderator='sdo_mean', hc='HC1',
+               replicates=1000, seed=None, workers=None, level=0.95):
+    # one row per outcome and term with the coefficient, robust SE, t and
+    # p-value (needs scipy), and bootstrap SE and percentile interval
+    try:
+        from scipy import stats
+    except ImportError:
+        stats = None
+
+    columns = ([item['name'] for kind in ['message', 'candidate']
+                for item in codebook['items'][kind]]
+               if columns is None else columns)
+    rows, design, terms = design_matrix(df, codebook, moderator=moderator)
+    values = df.loc[rows, columns].to_numpy(dtype='float64', na_value=np.nan)
+    coef, se, counts = fit_ols(design, values, hc=hc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = coef / se
+    residual_df = counts[:, None] - design.shape[1]
+
+    table = pd.DataFrame({
+        'outcome': np.repeat(columns, len(terms)),
+        'term': terms * len(columns),
+        'n': np.repeat(counts.astype('int64'), len(terms)),
+        'coef': coef.ravel(),
+        'se': se.ravel(),
+        't': t.ravel(),
+        'p_value': (2 * stats.t.sf(np.abs(t), residual_df)).ravel()
+                   if stats is not None else np.nan,
+    })
+    if replicates:
+        answered = ~np.isnan(values)
+        data = (design, np.where(answered, values, 0), answered.astype('float64'))
+        boot = run_tasks(regression_task, data, replicates, seed=seed, workers=workers)
+        # terms that are never estimable are all NaN and stay NaN, quietly
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            low, high = np.nanpercentile(
+                boot, [(1 - level) / 2 * 100, (1 + level) / 2 * 100], axis=0)
+            table['boot_se'] = np.nanstd(boot, axis=0, ddof=1).ravel()
+        table['lo'] = low.ravel()
+        table['hi'] = high.ravel()
+    return table
+
+
+# **Running the Analysis**
+
+# In[8]:
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Analyse the preprocessed SDO campaign messages data.')
+    parser.add_argument(
+        'filter', nargs='?', default=FILTER_FILE,
+        help='A2 output of the preprocessing script, as CSV or as a --columnar '
+             'dataset (default: %(default)s)')
+    parser.add_argument(
+        '--codebook', default=CODEBOOK_FILE,
+        help='codebook with the scale definitions (default: %(default)s)')
+    parser.add_argument(
+        '--analysis', action='append', choices=ANALYSES,
+        help='run only this analysis; may be repeated (default: all)')
+    parser.add_argument(
+        '--replicates', type=int, default=2000,
+        help='reliability bootstrap replicates, 0 to skip the intervals '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--bootstrap-replicates', type=int, default=10000,
+        help='replicates for the condition means bootstrap (default: %(default)s)')
+    parser.add_argument(
+        '--permutations', type=int, default=10000,
+        help='label permutations for the contrast tests (default: %(default)s)')
+    parser.add_argument(
+        '--regression-replicates', type=int, default=1000,
+        help='bootstrap replicates for the regression coefficients, 0 to skip '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--hc', choices=['HC0', 'HC1', 'HC3'], default='HC1',
+        help='robust standard error type for the regressions (default: %(default)s)')
+    parser.add_argument(
+        '--seed', type=int, default=None,
+        help='seed for the bootstrap resamples and permutations')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='worker processes for the resampling and permutations '
+             '(default: one per core)')
+    parser.add_argument(
+        '--by', action='append', default=[],
+        help='also run the ANOVA within each value of this column (e.g. Sex, '
+             'sdo_segment); may be repeated')
+    args = parser.parse_args(argv)
+    analyses = args.analysis or ANALYSES
+
+    codebook = load_codebook(args.codebook)
+    df = read_filter(args.filter)
+
+    if 'reliability' in analyses:
+        print('Computing scale reliability...\n')
+        table = reliability(df, codebook, replicates=args.replicates, seed=args.seed)
+        table.to_csv(RELIABILITY_FILE, index=False)
+        print(table.to_string(index=False, float_format='{:.3f}'.format))
+
+    if 'bootstrap' in analyses:
+        print('\nBootstrapping condition means...\n')
+        table = bootstrap_means(df, codebook, replicates=args.bootstrap_replicates,
+                                seed=args.seed, workers=args.workers)
+        table.to_csv(BOOTSTRAP_FILE, index=False)
+        print(table.to_string(index=False, float_format='{:.3f}'.format))
+
+    if 'permutation' in analyses:
+        print('\nRunning permutation tests...\n')
+        table = permutation_tests(df, codebook, permutations=args.permutations,
+                                  seed=args.seed, workers=args.workers)
+        table.to_csv(PERMUTATION_FILE, index=False)
+        print(table.to_string(index=False, float_format='{:.4f}'.format))
+
+    if 'anova' in analyses:
+        print('\nRunning factorial ANOVA...\n')
+        table = pd.concat([anova(df, codebook, by=by) for by in [None] + args.by],
+                          ignore_index=True)
+        table.to_csv(ANOVA_FILE, index=False)
+        print(table.to_string(index=False, float_format='{:.4f}'.format))
+
+    if 'regression' in analyses:
+        print('\nFitting moderation regressions...\n')
+        table = regression(df, codebook, hc=args.hc,
+                           replicates=args.regression_replicates,
+                           seed=args.seed, workers=args.workers)
+        table.to_csv(REGRESSION_FILE, index=False)
+        print(table.to_string(index=False, float_format='{:.4f}'.format))
+
+
+if __name__ == '__main__':
+    main()